@@ -1,3 +1,6 @@
+import os
+import sys
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -146,4 +149,38 @@ def plot_data_model(reddened_star, weights, modinfo, params_in, paramnames, star
     # ax.legend()
 
     # use the whitespace better
-    fig.tight_layout()
\ No newline at end of file
+    fig.tight_layout()
+
+
+def _import_fit_many():
+    """
+    fit_many.py from utils, only imported when used as it needs all the
+    packages for fit_model.py
+    """
+    utils_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils")
+    if utils_path not in sys.path:
+        sys.path.append(utils_path)
+    import fit_many
+
+    return fit_many
+
+
+def fit_many(starnames, options="", **kwargs):
+    """
+    Fit stars in parallel with fit_model.py (see fit_many in utils/fit_many.py)
+    """
+    return _import_fit_many().fit_many(starnames, options=options, **kwargs)
+
+
+def fit_pool(options="", **kwargs):
+    """
+    Process pool for fit_model.py fits (see FitPool in utils/fit_many.py)
+    """
+    return _import_fit_many().FitPool(options, **kwargs)
+
+
+def gather_results(futures, **kwargs):
+    """
+    Results of the fits from a fit_pool (see gather_results in utils/fit_many.py)
+    """
+    return _import_fit_many().gather_results(futures, **kwargs)
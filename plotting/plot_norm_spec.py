@@ -1,5 +1,7 @@
 import argparse
+import os
 import pickle
+import sys
 import emcee
 import matplotlib.pyplot as plt
 from matplotlib.ticker import ScalarFormatter
@@ -9,6 +11,10 @@ from measure_extinction.model import MEModel
 from measure_extinction.stardata import StarData
 from measure_extinction.extdata import ExtData
 
+# shared code in utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
+from grid_file import load_line_cont  # noqa: E402
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -22,6 +28,11 @@ def main():
     parser.add_argument(
         "--picmodname", help="name of pickled model", default="tlusty_z100_modinfo.p"
     )
+    parser.add_argument(
+        "--gridfile",
+        help="combined line and continuum grid file, used instead of the pickles",
+        default=None,
+    )
     parser.add_argument(
         "--bands", help="only use these observed bands", nargs="+", default=None
     )
@@ -56,10 +67,16 @@ def main():
     reddened_star = StarData(fstarname, path=f"{args.obspath}", only_bands=args.bands)
 
     # get the modeling info
-    modinfo = pickle.load(open(args.picmodname, "rb"))
-    modinfo_cont = pickle.load(
-        open(args.picmodname.replace("modinfo", "contmodinfo"), "rb")
-    )
+    if args.gridfile is not None:
+        modinfo, modinfo_cont = load_line_cont(
+            args.gridfile,
+            keys=list(reddened_star.data.keys()) + ["MODEL_FULL_LOWRES"],
+        )
+    else:
+        modinfo = pickle.load(open(args.picmodname, "rb"))
+        modinfo_cont = pickle.load(
+            open(args.picmodname.replace("modinfo", "contmodinfo"), "rb")
+        )
 
     # setup the ME model
     memod = MEModel(obsdata=reddened_star, modinfo=modinfo)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the code in utils is run as scripts, it is not an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils"))
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("measure_extinction")
+u = pytest.importorskip("astropy.units")
+
+import numpy as np  # noqa: E402
+
+import fast_model  # noqa: E402
+from like_profile import LikelihoodProfiler  # noqa: E402
+
+
+class ToyModel(fast_model.FastMEModel):
+    """
+    Forward model with a flat stellar SED and no extinction or HI absorption,
+    only the parts of MEModel used by the likelihood are set
+    """
+
+    def __init__(self, weights):
+        with mock.patch.object(fast_model.MEModel, "__init__", lambda *a, **k: None):
+            super().__init__()
+        self.weights = weights
+        self.norm = SimpleNamespace(value=2.0)
+
+    def stellar_sed(self, moddata):
+        return {cspec: np.copy(cfluxes[0]) for cspec, cfluxes in moddata.fluxes.items()}
+
+    def dust_extinguished_sed(self, moddata, sed):
+        return sed
+
+    def hi_abs_sed(self, moddata, sed):
+        return sed
+
+
+def _star(fluxes, npts):
+    return SimpleNamespace(
+        data={
+            cspec: SimpleNamespace(fluxes=cfluxes * u.Jy, npts=npts[cspec])
+            for cspec, cfluxes in fluxes.items()
+        }
+    )
+
+
+def _grid(npix):
+    return SimpleNamespace(
+        waves={
+            cspec: np.linspace(0.1, 1.0, cnpix) * u.micron
+            for cspec, cnpix in npix.items()
+        },
+        fluxes={cspec: np.ones((1, cnpix)) for cspec, cnpix in npix.items()},
+    )
+
+
+def test_binned_pixels_skip_bad_fluxes_and_weights():
+    modinfo = _grid({"STIS": 8})
+    fluxes = np.full(8, 2.0)
+    npts = np.ones(8)
+    weights = np.ones(8)
+    # masked pixel with a NaN flux and a pixel with a zero uncertainty
+    fluxes[2] = np.nan
+    npts[2] = 0
+    weights[5] = np.inf
+    memod = ToyModel({"STIS": weights})
+
+    memod.set_binned_pixels(_star({"STIS": fluxes}, {"STIS": npts}), modinfo, 4)
+
+    assert np.all(np.isfinite(memod.active_fluxes["STIS"]))
+    assert np.allclose(memod.active_fluxes["STIS"], 2.0)
+    assert np.allclose(memod.active_weights["STIS"], np.sqrt([3.0, 3.0]))
+    assert memod.lnlike(None, modinfo) == pytest.approx(0.0)
+
+
+def _reference_lnlike(memod, obsdata, modinfo):
+    """
+    chi^2 over the spectra of the star, as done by MEModel.lnlike
+    """
+    sed = memod.hi_abs_sed(
+        modinfo, memod.dust_extinguished_sed(modinfo, memod.stellar_sed(modinfo))
+    )
+    lnl = 0.0
+    for cspec, cdata in obsdata.data.items():
+        modspec = sed[cspec] * memod.norm.value
+        cweights = memod.weights[cspec]
+        gvals = (cweights > 0) & np.isfinite(modspec)
+        lnl += -0.5 * np.sum(
+            np.square((cdata.fluxes.value[gvals] - modspec[gvals]) * cweights[gvals])
+        )
+    return lnl
+
+
+def test_profiled_full_pixels_star_without_all_grid_spectra(monkeypatch):
+    monkeypatch.setattr(fast_model.MEModel, "lnlike", _reference_lnlike)
+    # the grid has spectra the star does not
+    modinfo = _grid({"BAND": 3, "STIS": 8, "WFC3_G102": 6, "MODEL_FULL_LOWRES": 20})
+    fluxes = {"BAND": np.full(3, 2.5), "STIS": np.linspace(1.5, 2.5, 8)}
+    npts = {cspec: np.ones(len(cfluxes)) for cspec, cfluxes in fluxes.items()}
+    memod = ToyModel(
+        {cspec: np.full(len(cfluxes), 2.0) for cspec, cfluxes in fluxes.items()}
+    )
+    memod.profiler = LikelihoodProfiler(fraction=1.0, seed=1)
+    obsdata = _star(fluxes, npts)
+
+    lnl = memod.lnlike(obsdata, modinfo)
+
+    assert lnl == pytest.approx(_reference_lnlike(memod, obsdata, modinfo))
+    assert memod._full_breakdown
+    assert memod.profiler.counts["chi2"] == 1
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("measure_extinction")
+Table = pytest.importorskip("astropy.table").Table
+
+import results_catalog  # noqa: E402
+
+
+def _ptab(av, av_unc, rv, rv_unc):
+    return Table(
+        {
+            "name": ["Av", "Rv"],
+            "value": [av, rv],
+            "unc": [av_unc, rv_unc],
+            "fixed": [0.0, 0.0],
+        }
+    )
+
+
+class FakeExtData(object):
+    """
+    Extinction file with MIN and MCMC fit parameters, the columns are from
+    the final (MCMC) fit as written by fit_model.py
+    """
+
+    def __init__(self, filename):
+        self.fit_params = {
+            "MIN": _ptab(0.2, 0.0, 3.0, 0.0),
+            "MCMC": _ptab(0.35, 0.02, 3.3, 0.1),
+        }
+        self.columns = {"AV": (0.35, 0.02), "RV": (3.3, 0.1)}
+
+
+def test_read_extfile_columns_per_fittype(tmp_path, monkeypatch):
+    extfile = tmp_path / "wdfs0000_00_mefit_ext.fits"
+    extfile.write_bytes(b"SIMPLE")
+    monkeypatch.setattr(results_catalog, "ExtData", FakeExtData)
+
+    rows = {
+        crow["fittype"]: crow for crow in results_catalog.read_extfile(str(extfile))
+    }
+
+    assert rows["MIN"]["star"] == "wdfs0000_00"
+    assert rows["MIN"]["col_AV"] == pytest.approx(0.2)
+    assert rows["MIN"]["col_AV_unc"] == pytest.approx(0.0)
+    assert rows["MIN"]["col_RV"] == pytest.approx(3.0)
+    assert rows["MCMC"]["col_AV"] == pytest.approx(0.35)
+    assert rows["MCMC"]["col_AV_unc"] == pytest.approx(0.02)
+    assert rows["MCMC"]["col_RV"] == pytest.approx(3.3)
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+import work_queue
+
+
+def test_claim_old_pending_job_not_requeued(tmp_path):
+    queuedir = str(tmp_path / "queue")
+    work_queue.submit(queuedir, ["wdfs0000_00"], options="--picmodel")
+
+    # the job has been waiting in pending for longer than the timeout
+    pendir = os.path.join(queuedir, "pending")
+    (jobname,) = os.listdir(pendir)
+    old = time.time() - 1000.0
+    os.utime(os.path.join(pendir, jobname), (old, old))
+
+    runname, job = work_queue.claim(queuedir, "worker1")
+    assert job["star"] == "wdfs0000_00"
+
+    # another worker's sweep does not see the claimed job as dead
+    assert work_queue.requeue_dead(queuedir, timeout=300.0) == 0
+    assert os.listdir(os.path.join(queuedir, "running")) == [runname]
+    assert os.listdir(pendir) == []
+
+
+def test_heartbeat_beats_before_first_interval(tmp_path):
+    runfile = tmp_path / "job.json"
+    runfile.write_text("{}")
+    old = time.time() - 1000.0
+    os.utime(runfile, (old, old))
+
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=work_queue._heartbeat, args=(str(runfile), 60.0, stop)
+    )
+    thread.start()
+    time.sleep(0.2)
+    stop.set()
+    thread.join()
+    assert time.time() - os.path.getmtime(runfile) < 10.0
+
+
+def test_requeued_job_is_stopped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queuedir = str(tmp_path / "queue")
+    work_queue.submit(queuedir, ["wdfs0000_00"], options="")
+    runname, job = work_queue.claim(queuedir, "worker1")
+
+    # a fit that would run much longer than the test
+    command = tmp_path / "slow_fit.py"
+    command.write_text("import time\ntime.sleep(60)\n")
+
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(
+            returncode=work_queue.run_job(
+                queuedir, runname, job, 0.1, command=str(command), nice=0
+            )
+        )
+    )
+    start = time.time()
+    thread.start()
+    time.sleep(0.5)
+
+    # another worker requeues the job
+    os.unlink(os.path.join(queuedir, "running", runname))
+    thread.join(timeout=30.0)
+    assert not thread.is_alive()
+    assert result["returncode"] < 0
+    assert time.time() - start < 30.0
@@ -0,0 +1,238 @@
+import argparse
+import glob
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import h5py
+import emcee
+from astropy.table import Table
+
+from measure_extinction.extdata import ExtData
+
+
+def read_param_chain(dset, k, niter, chunk=5000):
+    """
+    Chain of one parameter read from the backend in chunks of steps
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        chain dataset (nsteps, nwalkers, ndim) of an emcee HDFBackend
+    k : int
+        parameter index
+    niter : int
+        number of steps that have been saved
+    chunk : int
+        number of steps read at once
+
+    Returns
+    -------
+    x : ndarray
+        chain (niter, nwalkers)
+    """
+    x = np.empty((niter, dset.shape[1]))
+    for i0 in range(0, niter, chunk):
+        i1 = min(i0 + chunk, niter)
+        x[i0:i1] = dset[i0:i1, :, k]
+    return x
+
+
+def split_rhat(x):
+    """
+    Split R-hat (Gelman et al. 2013) treating each walker as a chain
+
+    Parameters
+    ----------
+    x : ndarray
+        chain (nsteps, nwalkers)
+    """
+    n = x.shape[0] // 2
+    chains = np.concatenate([x[:n], x[n : 2 * n]], axis=1)
+    W = np.mean(np.var(chains, axis=0, ddof=1))
+    if W <= 0.0:
+        return np.nan
+    B = n * np.var(np.mean(chains, axis=0), ddof=1)
+    return np.sqrt(((n - 1) / n * W + B / n) / W)
+
+
+def param_names(extfile, ndim):
+    """
+    Names of the fit parameters from the MCMC fit parameters saved with the
+    extinction curve, default names if they are not available
+    """
+    if os.path.isfile(extfile):
+        ptab = ExtData(filename=extfile).fit_params.get("MCMC")
+        if ptab is not None and "name" in ptab.colnames:
+            if "fixed" in ptab.colnames:
+                names = [
+                    cname
+                    for cname, cfix in zip(ptab["name"], ptab["fixed"])
+                    if cfix < 0.1
+                ]
+            else:
+                names = list(ptab["name"])
+            if len(names) == ndim:
+                return [str(cname) for cname in names]
+    return [f"p{k}" for k in range(ndim)]
+
+
+def diagnose(sampfile, burnfrac=0.5, chunk=5000, ntau_min=50.0, rhat_max=1.05):
+    """
+    Convergence diagnostics for each parameter of one MCMC run
+
+    Parameters
+    ----------
+    sampfile : str
+        emcee HDFBackend file (exts/{star}_mefit_.h5)
+    burnfrac : float
+        fraction of the steps discarded as burn-in
+    chunk : int
+        number of steps read at once
+    ntau_min : float
+        minimum number of autocorrelation times for a converged chain
+    rhat_max : float
+        maximum split R-hat for a converged chain
+
+    Returns
+    -------
+    rows : list of dict
+        diagnostics for each parameter
+    """
+    star = os.path.basename(sampfile).replace("_mefit_.h5", "")
+    with h5py.File(sampfile, "r") as hfile:
+        group = hfile["mcmc"]
+        niter = int(group.attrs["iteration"])
+        accfrac = group["accepted"][()] / max(niter, 1)
+        nwalkers, ndim = group["chain"].shape[1:]
+        names = param_names(sampfile.replace("_.h5", "_ext.fits"), ndim)
+
+        # only the chain of one parameter is in memory at a time
+        nburn = int(burnfrac * niter)
+        rows = []
+        for k, cname in enumerate(names):
+            x = read_param_chain(group["chain"], k, niter, chunk)[nburn:]
+            tau = emcee.autocorr.integrated_time(x[:, :, None], quiet=True)[0]
+            nkept = x.shape[0]
+            crow = {
+                "star": star,
+                "param": cname,
+                "nsteps": niter,
+                "nwalkers": nwalkers,
+                "tau": tau,
+                "ntau": nkept / tau,
+                "ess": nkept * nwalkers / tau,
+                "rhat": split_rhat(x),
+                "acc_mean": np.mean(accfrac),
+                "acc_min": np.min(accfrac),
+                "burnin": int(np.ceil(2.0 * tau)),
+            }
+            reasons = []
+            if crow["ntau"] < ntau_min:
+                reasons.append(f"chain < {ntau_min:g} tau")
+            if not crow["rhat"] <= rhat_max:
+                reasons.append(f"R-hat > {rhat_max:g}")
+            if crow["burnin"] > nburn:
+                reasons.append("burn-in > discarded steps")
+            if crow["acc_min"] < 0.1:
+                reasons.append("acceptance < 0.1")
+            crow["flag"] = ", ".join(reasons)
+            rows.append(crow)
+    return rows
+
+
+def _diagnose_kwargs(args):
+    """
+    Diagnostics for one file, an error (e.g., a run still in progress or a
+    corrupt file) is returned instead of stopping the report
+    """
+    sampfile, kwargs = args
+    try:
+        return diagnose(sampfile, **kwargs), None
+    except Exception as err:
+        return [], f"{err!r}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--extpath", help="path to the MCMC sample files", default="./exts/"
+    )
+    parser.add_argument("--burnfrac", help="burn fraction", default=0.5, type=float)
+    parser.add_argument(
+        "--chunk", help="number of steps read at once", default=5000, type=int
+    )
+    parser.add_argument(
+        "--ntau_min",
+        help="minimum chain length in autocorrelation times",
+        default=50.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--rhat_max", help="maximum split R-hat", default=1.05, type=float
+    )
+    parser.add_argument(
+        "--sort", help="column to sort the table by", default="ntau", type=str
+    )
+    parser.add_argument(
+        "--outname",
+        help="base name of the output table and flag list",
+        default="./exts/chain_diagnostics",
+    )
+    parser.add_argument(
+        "--nproc", help="number of files analyzed in parallel", default=4, type=int
+    )
+    args = parser.parse_args()
+
+    start_time = time.time()
+    sampfiles = sorted(glob.glob(os.path.join(args.extpath, "*_mefit_.h5")))
+    kwargs = {
+        "burnfrac": args.burnfrac,
+        "chunk": args.chunk,
+        "ntau_min": args.ntau_min,
+        "rhat_max": args.rhat_max,
+    }
+    with Pool(args.nproc) as pool:
+        results = pool.map(_diagnose_kwargs, [(cfile, kwargs) for cfile in sampfiles])
+
+    rows = [crow for crows, error in results for crow in crows]
+    failed = {
+        os.path.basename(cfile).replace("_mefit_.h5", ""): error
+        for cfile, (crows, error) in zip(sampfiles, results)
+        if error is not None
+    }
+    for cstar, error in failed.items():
+        print(f"{cstar}: failed to read the chains, {error}")
+    if len(rows) == 0:
+        print(f"no readable MCMC sample files found in {args.extpath}")
+        return
+    dtab = Table(rows=rows)
+    dtab.sort(args.sort)
+    for cname in ["tau", "ntau", "ess"]:
+        dtab[cname].format = ".1f"
+    for cname in ["rhat", "acc_mean", "acc_min"]:
+        dtab[cname].format = ".3f"
+    dtab.write(f"{args.outname}.ecsv", overwrite=True)
+    dtab.pprint_all()
+
+    # stars that need longer chains
+    flagged = {}
+    for crow in dtab:
+        if crow["flag"] != "":
+            flagged.setdefault(crow["star"], []).append(
+                f"{crow['param']}: {crow['flag']}"
+            )
+    for cstar, error in failed.items():
+        flagged[cstar] = [f"failed: {error}"]
+    with open(f"{args.outname}_flags.txt", "w") as ofile:
+        for cstar in sorted(flagged.keys()):
+            ofile.write(f"{cstar} ({"; ".join(flagged[cstar])})\n")
+    print(f"{len(flagged) - len(failed)} of {len(sampfiles)} stars need longer chains")
+    print(f"{len(failed)} of {len(sampfiles)} files could not be read")
+    print(f"flag list in {args.outname}_flags.txt")
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
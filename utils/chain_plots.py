@@ -0,0 +1,257 @@
+import argparse
+
+import numpy as np
+import h5py
+import matplotlib.pyplot as plt
+
+
+def _chunks(niter, chunk, start=0):
+    """
+    Ranges of steps read at once
+    """
+    for i0 in range(start, niter, chunk):
+        yield i0, min(i0 + chunk, niter)
+
+
+def chain_envelopes(sampfile, nbins=1000, nwalkers_show=4, chunk=5000):
+    """
+    Summary of the chains in bins of steps from one pass over the backend
+
+    Parameters
+    ----------
+    sampfile : str
+        emcee HDFBackend file
+    nbins : int
+        number of step bins
+    nwalkers_show : int
+        number of walkers to keep decimated traces for
+    chunk : int
+        number of steps read at once, rounded to a multiple of the bin size
+
+    Returns
+    -------
+    env : dict
+        "steps" bin centers, "min", "max", "mean" (nbins, ndim) over all the
+        walkers and the steps in each bin, "walkers" (nbins, nwalkers_show,
+        ndim) the first step of each bin for a few walkers
+    """
+    with h5py.File(sampfile, "r") as hfile:
+        dset = hfile["mcmc/chain"]
+        niter = int(hfile["mcmc"].attrs["iteration"])
+        nwalkers, ndim = dset.shape[1:]
+        binsize = max(niter // nbins, 1)
+        nbins = int(np.ceil(niter / binsize))
+        chunk = max(chunk // binsize, 1) * binsize
+
+        env = {
+            "steps": (np.arange(nbins) + 0.5) * binsize,
+            "min": np.empty((nbins, ndim)),
+            "max": np.empty((nbins, ndim)),
+            "mean": np.empty((nbins, ndim)),
+            "walkers": np.empty((nbins, min(nwalkers_show, nwalkers), ndim)),
+        }
+        for i0, i1 in _chunks(niter, chunk):
+            x = dset[i0:i1]
+            b0 = i0 // binsize
+            for k in range(0, i1 - i0, binsize):
+                cx = x[k : k + binsize]
+                env["min"][b0] = np.min(cx, axis=(0, 1))
+                env["max"][b0] = np.max(cx, axis=(0, 1))
+                env["mean"][b0] = np.mean(cx, axis=(0, 1))
+                env["walkers"][b0] = cx[0, : env["walkers"].shape[1]]
+                b0 += 1
+    return env
+
+
+def streaming_histograms(sampfile, burnfrac=0.5, nbins=50, chunk=5000, nrange=200):
+    """
+    1D and 2D histograms of the samples accumulated in a pass over the backend
+
+    The histogram ranges are the 0.1 and 99.9 percentiles of a thinned
+    subsample of the chain.
+
+    Parameters
+    ----------
+    sampfile : str
+        emcee HDFBackend file
+    burnfrac : float
+        fraction of the steps discarded as burn-in
+    nbins : int
+        number of histogram bins for each parameter
+    chunk : int
+        number of steps read at once
+    nrange : int
+        number of steps in the subsample used to set the ranges
+
+    Returns
+    -------
+    hists : dict
+        "edges" list of bin edges, "hist1d" (ndim, nbins), "hist2d"
+        (ndim, ndim, nbins, nbins) with [i, j] the histogram of parameter i
+        (y) versus j (x) for i > j
+    """
+    with h5py.File(sampfile, "r") as hfile:
+        dset = hfile["mcmc/chain"]
+        niter = int(hfile["mcmc"].attrs["iteration"])
+        ndim = dset.shape[2]
+        nburn = int(burnfrac * niter)
+
+        thin = max((niter - nburn) // nrange, 1)
+        sub = dset[nburn:niter:thin].reshape(-1, ndim)
+        ranges = np.percentile(sub, [0.1, 99.9], axis=0).T
+        ranges[ranges[:, 0] == ranges[:, 1]] += [-0.5, 0.5]
+        edges = [np.linspace(crange[0], crange[1], nbins + 1) for crange in ranges]
+
+        hist1d = np.zeros((ndim, nbins))
+        hist2d = np.zeros((ndim, ndim, nbins, nbins))
+        for i0, i1 in _chunks(niter, chunk, start=nburn):
+            x = dset[i0:i1].reshape(-1, ndim)
+            for i in range(ndim):
+                hist1d[i] += np.histogram(x[:, i], bins=edges[i])[0]
+                for j in range(i):
+                    hist2d[i, j] += np.histogram2d(
+                        x[:, i], x[:, j], bins=[edges[i], edges[j]]
+                    )[0]
+    return {"edges": edges, "hist1d": hist1d, "hist2d": hist2d}
+
+
+def plot_chains(env, names):
+    """
+    Plot the chain envelopes (min to max), mean, and a few walkers
+    """
+    ndim = len(names)
+    fig, axes = plt.subplots(ndim, figsize=(10, 1.5 * ndim + 1), sharex=True)
+    axes = np.atleast_1d(axes)
+    for k, ax in enumerate(axes):
+        ax.fill_between(
+            env["steps"], env["min"][:, k], env["max"][:, k], color="k", alpha=0.2
+        )
+        ax.plot(env["steps"], env["walkers"][:, :, k], "-", alpha=0.5, lw=0.5)
+        ax.plot(env["steps"], env["mean"][:, k], "k-", lw=1)
+        ax.set_ylabel(names[k])
+        ax.yaxis.set_label_coords(-0.1, 0.5)
+    axes[-1].set_xlabel("step number")
+    return fig
+
+
+def _quantiles(hist, edges, quants=[0.16, 0.5, 0.84]):
+    """
+    Quantiles interpolated from the cumulative histogram
+    """
+    cdf = np.concatenate([[0.0], np.cumsum(hist)]) / max(np.sum(hist), 1.0)
+    return np.interp(quants, cdf, edges)
+
+
+def plot_corner(hists, names):
+    """
+    Corner plot from precomputed 1D and 2D histograms
+
+    The 16, 50, and 84 percentiles are shown on the 1D histograms and the
+    2D histograms are shown as images.
+    """
+    ndim = len(names)
+    edges = hists["edges"]
+    fig, axes = plt.subplots(ndim, ndim, figsize=(2 * ndim + 1, 2 * ndim + 1))
+    axes = np.atleast_2d(axes)
+    for i in range(ndim):
+        for j in range(ndim):
+            ax = axes[i, j]
+            if j > i:
+                ax.set_axis_off()
+                continue
+            if i == j:
+                ax.stairs(hists["hist1d"][i], edges[i], color="k")
+                cquants = _quantiles(hists["hist1d"][i], edges[i])
+                for cval in cquants:
+                    ax.axvline(cval, color="k", linestyle="--", lw=1)
+                ax.set_title(
+                    f"{names[i]} = {cquants[1]:.3g}"
+                    f"$^{{+{cquants[2] - cquants[1]:.2g}}}"
+                    f"_{{-{cquants[1] - cquants[0]:.2g}}}$",
+                    fontsize="small",
+                )
+                ax.set_yticks([])
+            else:
+                ax.pcolormesh(
+                    edges[j],
+                    edges[i],
+                    hists["hist2d"][i, j],
+                    cmap="Greys",
+                    shading="flat",
+                )
+            ax.set_xlim(edges[j][0], edges[j][-1])
+            if i < ndim - 1:
+                ax.set_xticklabels([])
+            else:
+                ax.set_xlabel(names[j])
+                ax.tick_params(axis="x", labelrotation=45)
+            if j > 0 or i == 0:
+                ax.set_yticklabels([])
+            else:
+                ax.set_ylabel(names[i])
+    fig.subplots_adjust(wspace=0.05, hspace=0.05)
+    return fig
+
+
+def fast_sampler_plots(sampfile, names, outname, burnfrac=0.5, chunk=5000, writer=None):
+    """
+    Chain and corner plots made from summaries of the backend
+
+    The cost of the plots does not depend on the length of the chains.
+
+    Parameters
+    ----------
+    sampfile : str
+        emcee HDFBackend file
+    names : list of str
+        names of the fit parameters
+    outname : str
+        base name of the figures (outname_mcmc_chains, outname_mcmc_corner)
+    burnfrac : float
+        fraction of the steps discarded as burn-in for the corner plot
+    chunk : int
+        number of steps read at once
+    writer : OutputWriter
+        writer for the figures (optional)
+    """
+    fig = plot_chains(chain_envelopes(sampfile, chunk=chunk), names)
+    _save_figure(fig, outname, "mcmc_chains", writer)
+
+    hists = streaming_histograms(sampfile, burnfrac=burnfrac, chunk=chunk)
+    fig = plot_corner(hists, names)
+    _save_figure(fig, outname, "mcmc_corner", writer)
+
+
+def _save_figure(fig, outname, ptype, writer):
+    """
+    Save a figure as pdf and png, using the writer if given
+    """
+    filenames = [f"{outname}_{ptype}.pdf", f"{outname}_{ptype}.png"]
+    if writer is not None:
+        writer.savefig(fig, filenames)
+    else:
+        for cname in filenames:
+            fig.savefig(cname)
+        plt.close(fig)
+
+
+if __name__ == "__main__":
+    from chain_diagnostics import param_names
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("starname", help="Name of star")
+    parser.add_argument("--burnfrac", help="burn fraction", default=0.5, type=float)
+    parser.add_argument(
+        "--chunk", help="number of steps read at once", default=5000, type=int
+    )
+    args = parser.parse_args()
+
+    outname = f"figs/{args.starname}_mefit"
+    sampfile = f"{outname.replace("figs", "exts")}_.h5"
+    with h5py.File(sampfile, "r") as hfile:
+        ndim = hfile["mcmc/chain"].shape[2]
+    names = param_names(f"{outname.replace("figs", "exts")}_ext.fits", ndim)
+
+    fast_sampler_plots(
+        sampfile, names, outname, burnfrac=args.burnfrac, chunk=args.chunk
+    )
@@ -0,0 +1,143 @@
+import numpy as np
+from scipy import interpolate
+import astropy.units as u
+
+from dust_extinction.parameter_averages import G23
+
+
+class DustBasis(object):
+    """
+    Precomputed wavelength dependent terms of the extinction curve
+
+    The extinction curve is the one used by MEModel.dust_extinguished_sed:
+    FM90 (B3 version) in the UV and G23 in the optical/IR joined with a cubic
+    spline anchored at two UV points (the F99 method).  For fixed wavelengths
+    all the terms that only depend on x = 1/lambda are computed once:
+
+    * UV: x and x^2 (the Drude profile is evaluated from x^2 for the current
+      xo and gamma) and the far-UV curvature positions
+    * optical/IR: the spline is linear in the values at the spline points,
+      and G23 is linear in 1/Rv, so the curve is a fixed combination of
+      precomputed basis arrays with weights set by Rv and the two UV
+      anchor values
+
+    The velocity shift of the wavelengths is included exactly in the UV and
+    to first order in the optical/IR (using the derivative of the spline),
+    the error is of order (v/c)^2.
+
+    The parameters can be arrays to evaluate the curves for many stars
+    at once.
+
+    Parameters
+    ----------
+    modinfo : ModelData
+        model grid giving the data wavelengths
+    """
+
+    # x value above which FM90 is used and the UV spline points [1/micron]
+    x_cut_uv = 1e4 / 2700.0
+    x_spline_uv = 1e4 / np.array([2700.0, 2600.0])
+    # optical/IR spline points [micron]
+    optnir_waves = np.arange(0.35, 30.0, 0.1)
+    # updated F04 C1-C2 correlation
+    c1_zero = 2.18
+    c1_slope = -2.91
+
+    def __init__(self, modinfo):
+        optnir_x = np.flip(1.0 / self.optnir_waves)
+        spline_x = np.concatenate([[0.0], optnir_x, self.x_spline_uv])
+        nknots = len(spline_x)
+
+        # G23 at the optical/IR spline points is a + b (1/Rv - 1/3.1)
+        g23_a = G23(Rv=3.1)(optnir_x / u.micron)
+        g23_b = (G23(Rv=5.0)(optnir_x / u.micron) - g23_a) / (1.0 / 5.0 - 1.0 / 3.1)
+
+        self.uv_indxs = {}
+        self.uv_x = {}
+        self.opir_indxs = {}
+        self.opir_basis = {}
+        self.npix = {}
+        self.waves = {}
+        for cspec in modinfo.fluxes.keys():
+            x = 1.0 / modinfo.waves[cspec].to(u.micron).value
+            self.npix[cspec] = len(x)
+            self.waves[cspec] = modinfo.waves[cspec]
+            (self.uv_indxs[cspec],) = np.where(x >= self.x_cut_uv)
+            (self.opir_indxs[cspec],) = np.where(x < self.x_cut_uv)
+            self.uv_x[cspec] = x[self.uv_indxs[cspec]]
+
+            # spline and spline derivative for a unit value at each spline point
+            opir_x = x[self.opir_indxs[cspec]]
+            basis = np.zeros((2, len(opir_x), nknots))
+            for j in range(nknots):
+                cy = np.zeros(nknots)
+                cy[j] = 1.0
+                cspline = interpolate.CubicSpline(spline_x, cy, bc_type="natural")
+                basis[0, :, j] = cspline(opir_x)
+                basis[1, :, j] = opir_x * cspline(opir_x, 1)
+
+            # combine into the terms multiplied by 1, (1/Rv - 1/3.1) and the
+            # two UV anchor values, for the curve and its derivative
+            self.opir_basis[cspec] = {
+                "a": basis[:, :, 1:-2] @ g23_a,
+                "b": basis[:, :, 1:-2] @ g23_b,
+                "uv": basis[:, :, -2:],
+            }
+
+    @staticmethod
+    def fm90_b3(x, C1, C2, B3, C4, xo, gamma):
+        """
+        FM90 E(x-V)/E(B-V) with the bump amplitude B3 = C3/gamma^2
+        """
+        x2 = np.square(x)
+        exvebv = C1 + C2 * x
+        exvebv = exvebv + B3 * x2 * gamma**2 / (np.square(x2 - xo**2) + x2 * gamma**2)
+        y = np.clip(x - 5.9, 0.0, None)
+        exvebv = exvebv + C4 * (0.5392 * np.square(y) + 0.05644 * y**3)
+        return exvebv
+
+    def axav(self, Rv, C2, B3, C4, xo, gamma, velocity):
+        """
+        A(lambda)/A(V) for the data wavelengths
+
+        Parameters
+        ----------
+        Rv, C2, B3, C4, xo, gamma, velocity : floats or ndarrays
+            extinction parameters and velocity [km/s], arrays have one
+            value per star
+
+        Returns
+        -------
+        axav : dict
+            A(lambda)/A(V) with shape (nstars, npix) for each spectrum key
+        """
+        Rv, C2, B3, C4, xo, gamma, velocity = [
+            np.atleast_1d(cval)[:, None]
+            for cval in [Rv, C2, B3, C4, xo, gamma, velocity]
+        ]
+        C1 = self.c1_zero + self.c1_slope * C2
+        # wavelengths shifted by -velocity, so x is scaled by 1/(1 - v/c)
+        dlnx = 1.0 / (1.0 - velocity / 2.998e5) - 1.0
+
+        uv_anchors = self.fm90_b3(self.x_spline_uv[None, :], C1, C2, B3, C4, xo, gamma)
+        uv_anchors = uv_anchors / Rv + 1.0
+        rv_term = 1.0 / Rv - 1.0 / 3.1
+
+        axav = {}
+        for cspec in self.npix.keys():
+            axav[cspec] = np.zeros((len(Rv), self.npix[cspec]))
+
+            ux = self.uv_x[cspec][None, :] * (1.0 + dlnx)
+            axav[cspec][:, self.uv_indxs[cspec]] = (
+                self.fm90_b3(ux, C1, C2, B3, C4, xo, gamma) / Rv + 1.0
+            )
+
+            cbasis = self.opir_basis[cspec]
+            vals = (
+                cbasis["a"][:, None, :]
+                + rv_term[None, :, :] * cbasis["b"][:, None, :]
+                + np.einsum("dpk,sk->dsp", cbasis["uv"], uv_anchors)
+            )
+            axav[cspec][:, self.opir_indxs[cspec]] = vals[0] + dlnx * vals[1]
+
+        return axav
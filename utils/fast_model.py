@@ -0,0 +1,544 @@
+import copy
+from collections.abc import Mapping
+from contextlib import nullcontext
+
+import numpy as np
+
+from measure_extinction.model import MEModel
+
+from lya_table import LyaTable
+from dust_basis import DustBasis
+
+
+def _same_waves(waves1, waves2):
+    """
+    Check that two wavelength arrays are the same
+    """
+    if waves1 is waves2:
+        return True
+    return len(waves1) == len(waves2) and np.array_equal(
+        getattr(waves1, "value", waves1), getattr(waves2, "value", waves2)
+    )
+
+
+def _matches(waves, moddata):
+    """
+    Check that a precomputed piece was built for the wavelengths of the model
+    grid
+    """
+    return all(
+        (cspec in waves.keys()) and _same_waves(waves[cspec], cwaves)
+        for cspec, cwaves in moddata.waves.items()
+    )
+
+
+def _map_modinfo(modinfo, transforms):
+    """
+    Copy of the model grid with a transform applied to the pixels of each
+    spectrum, spectrum keys without a transform are dropped
+    """
+    newmodinfo = copy.copy(modinfo)
+    for cname, cattr in vars(modinfo).items():
+        if isinstance(cattr, Mapping) and set(cattr.keys()) == set(
+            modinfo.fluxes.keys()
+        ):
+            newattr = {}
+            for cspec, ctrans in transforms.items():
+                cvals = cattr[cspec]
+                npix = len(modinfo.waves[cspec])
+                if hasattr(cvals, "shape") and cvals.shape[-1] == npix:
+                    cvals = ctrans(cvals)
+                newattr[cspec] = cvals
+            setattr(newmodinfo, cname, newattr)
+    return newmodinfo
+
+
+def subset_modinfo(modinfo, indxs):
+    """
+    Copy of the model grid with only some of the pixels of each spectrum
+
+    Parameters
+    ----------
+    modinfo : ModelData
+        model grid
+    indxs : dict
+        pixels to keep for each spectrum key, other keys are dropped
+
+    Returns
+    -------
+    submodinfo : ModelData
+        model grid with only the selected pixels
+    """
+    return _map_modinfo(
+        modinfo,
+        {cspec: (lambda x, i=cindxs: x[..., i]) for cspec, cindxs in indxs.items()},
+    )
+
+
+def bin_modinfo(modinfo, bmats):
+    """
+    Copy of the model grid with the pixels of each spectrum binned
+
+    Parameters
+    ----------
+    modinfo : ModelData
+        model grid
+    bmats : dict
+        binning matrix (nbins, npix) for each spectrum key, each row gives
+        the weights of the pixels in a bin, other keys are dropped
+
+    Returns
+    -------
+    binmodinfo : ModelData
+        model grid with the binned pixels
+    """
+    # only the pixels with weight are used, so the model values of the others
+    # (e.g., NaN in masked regions) do not change the bins
+    transforms = {}
+    for cspec, cbmat in bmats.items():
+        (cused,) = np.where(np.any(cbmat > 0.0, axis=0))
+        transforms[cspec] = lambda x, b=cbmat[:, cused], i=cused: x[..., i] @ b.T
+    return _map_modinfo(modinfo, transforms)
+
+
+class FastMEModel(MEModel):
+    """
+    MEModel with optional precomputed, per star pieces of the forward model
+
+    The precomputed pieces are built once the model is setup for a star.
+    Without them the results are identical to MEModel.  Each piece is only
+    used for the wavelengths it was built for, otherwise (e.g., when plotting
+    the full spectra) the direct calculation is done.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lya_table = None
+        self.dust_basis = None
+        self.active_modinfo = None
+        self.active_indxs = None
+        self.emulators = []
+        self.profiler = None
+        self._profiling = False
+        # None until the full pixel breakdown is checked against MEModel.lnlike
+        self._full_breakdown = None
+
+    def velocity_halo(self, waves):
+        """
+        Number of pixels needed on each side of a pixel for the velocity shift
+
+        The shift is at most the largest velocity allowed by the velocity
+        bounds (or the fixed value) and one more pixel is needed for the
+        interpolation.
+
+        Parameters
+        ----------
+        waves : astropy.Quantity
+            wavelengths of a spectrum
+        """
+        if self.velocity.fixed:
+            vmax = abs(self.velocity.value)
+        else:
+            bounds = self.velocity.bounds
+            if bounds is None or bounds[0] is None or bounds[1] is None:
+                raise ValueError("velocity must be bounded to use active pixels")
+            vmax = max(abs(bounds[0]), abs(bounds[1]))
+        cwaves = getattr(waves, "value", waves)
+        dwaves = np.absolute(np.diff(cwaves))
+        dwave = np.min(dwaves[dwaves > 0.0])
+        return int(np.ceil(vmax / 2.998e5 * np.max(cwaves) / dwave)) + 1
+
+    def set_active_pixels(self, obsdata, modinfo, halo=None):
+        """
+        Restrict the likelihood to the pixels that contribute to the chi^2
+
+        Pixels with zero weight (excluded regions, no data) are not computed.
+        A halo of pixels is kept around the active ones so the interpolation
+        for the velocity shift is unchanged, by default it is sized from the
+        velocity bounds and the pixel spacing of each spectrum (see
+        velocity_halo).  The model grid for the active pixels is in
+        active_modinfo and any precomputed pieces should be built using it.
+
+        Parameters
+        ----------
+        obsdata : StarData
+            observed data
+        modinfo : ModelData
+            model grid
+        halo : int
+            number of pixels to keep on each side of the active pixels,
+            default is from the velocity bounds
+        """
+        indxs = {}
+        for cspec in modinfo.fluxes.keys():
+            if cspec not in obsdata.data.keys():
+                continue
+            gvals = (self.weights[cspec] > 0) & (obsdata.data[cspec].npts > 0)
+            if not np.any(gvals):
+                continue
+            if cspec != "BAND":
+                chalo = halo
+                if chalo is None:
+                    chalo = self.velocity_halo(modinfo.waves[cspec])
+                    print(f"{cspec}: velocity halo of {chalo} pixels")
+                hvals = np.copy(gvals)
+                for k in range(1, chalo + 1):
+                    hvals[k:] |= gvals[:-k]
+                    hvals[:-k] |= gvals[k:]
+                gvals = hvals
+            (indxs[cspec],) = np.where(gvals)
+
+        self.active_indxs = indxs
+        self.active_modinfo = subset_modinfo(modinfo, indxs)
+        self.active_fluxes = {
+            cspec: obsdata.data[cspec].fluxes.value[cindxs]
+            for cspec, cindxs in indxs.items()
+        }
+        self.active_weights = {
+            cspec: self.weights[cspec][cindxs] for cspec, cindxs in indxs.items()
+        }
+
+        nfull = sum(len(modinfo.waves[cspec]) for cspec in modinfo.fluxes.keys())
+        nactive = sum(len(cindxs) for cindxs in indxs.values())
+        print(f"active pixels: {nactive} of {nfull}")
+
+    def set_binned_pixels(self, obsdata, modinfo, binfac):
+        """
+        Use binned spectra in the likelihood for a fast, coarse fit
+
+        Each spectrum is binned into superpixels of binfac pixels using the
+        inverse variance weights and the model grid is binned the same way.
+        The binned data and grid are used as the active pixels.  As the dust
+        extinction and HI absorption are applied to the binned model, this is
+        an approximation and the fit should be refined at full resolution.
+
+        Parameters
+        ----------
+        obsdata : StarData
+            observed data
+        modinfo : ModelData
+            model grid
+        binfac : int
+            number of pixels in each superpixel
+        """
+        bmats = {}
+        self.active_fluxes = {}
+        self.active_weights = {}
+        for cspec in modinfo.fluxes.keys():
+            if cspec not in obsdata.data.keys():
+                continue
+            ivar = np.square(self.weights[cspec])
+            fluxes = np.copy(obsdata.data[cspec].fluxes.value)
+            # masked pixels and ones with bad weights or fluxes are not used,
+            # both are zeroed as 0 * NaN would still give NaN bins
+            bvals = (
+                (obsdata.data[cspec].npts <= 0)
+                | ~(np.isfinite(ivar) & (ivar > 0.0))
+                | ~np.isfinite(fluxes)
+            )
+            ivar[bvals] = 0.0
+            fluxes[bvals] = 0.0
+            npix = len(ivar)
+            if cspec == "BAND":
+                binids = np.arange(npix)
+            else:
+                binids = np.arange(npix) // binfac
+            bmat = np.zeros((binids[-1] + 1, npix))
+            bmat[binids, np.arange(npix)] = ivar
+            bivar = np.sum(bmat, axis=1)
+            gvals = bivar > 0.0
+            if not np.any(gvals):
+                continue
+            bmats[cspec] = bmat[gvals] / bivar[gvals, None]
+            self.active_fluxes[cspec] = bmats[cspec] @ fluxes
+            self.active_weights[cspec] = np.sqrt(bivar[gvals])
+
+        self.active_indxs = None
+        self.active_modinfo = bin_modinfo(modinfo, bmats)
+
+        nfull = sum(len(modinfo.waves[cspec]) for cspec in modinfo.fluxes.keys())
+        nbinned = sum(len(cbmat) for cbmat in bmats.values())
+        print(f"binned pixels: {nbinned} from {nfull}")
+
+    def lnlike(self, obsdata, modinfo):
+        """
+        Log(likelihood) computed only on the active (selected or binned)
+        pixels when they are set
+
+        When a profiler is set, a sample of the calls are timed.
+        """
+        if self.profiler is not None and self.profiler.sample():
+            return self._profiled_lnlike(obsdata, modinfo)
+        return self._lnlike(obsdata, modinfo)
+
+    def _lnlike(self, obsdata, modinfo):
+        if self.active_modinfo is None:
+            if self._profiling and self._full_breakdown:
+                return self._full_lnlike(obsdata, modinfo)
+            return super().lnlike(obsdata, modinfo)
+
+        amodinfo = self.active_modinfo
+        modsed = self.stellar_sed(amodinfo)
+        ext_modsed = self.dust_extinguished_sed(amodinfo, modsed)
+        hi_ext_modsed = self.hi_abs_sed(amodinfo, ext_modsed)
+        return self._norm_chi2(hi_ext_modsed, self.active_fluxes, self.active_weights)
+
+    def _full_lnlike(self, obsdata, modinfo):
+        """
+        Log(likelihood) for all the pixels done in the same parts as for the
+        active pixels, only used for profiling
+        """
+        modsed = self.stellar_sed(modinfo)
+        ext_modsed = self.dust_extinguished_sed(modinfo, modsed)
+        hi_ext_modsed = self.hi_abs_sed(modinfo, ext_modsed)
+        # the grid can have spectra the star does not (e.g., MODEL_FULL_LOWRES)
+        fluxes = {}
+        weights = {}
+        for cspec in hi_ext_modsed.keys():
+            if cspec in obsdata.data.keys() and cspec in self.weights.keys():
+                fluxes[cspec] = obsdata.data[cspec].fluxes.value
+                weights[cspec] = self.weights[cspec]
+        return self._norm_chi2(hi_ext_modsed, fluxes, weights)
+
+    def _norm_chi2(self, hi_ext_modsed, fluxes, weights):
+        """
+        Normalization and chi^2 of the model SED for the pixels in weights
+        """
+        with self._timer("norm"):
+            modspecs = {
+                cspec: hi_ext_modsed[cspec] * self.norm.value
+                for cspec in weights.keys()
+            }
+
+        lnl = 0.0
+        with self._timer("chi2"):
+            for cspec, cweights in weights.items():
+                modspec = modspecs[cspec]
+                gvals = (cweights > 0) & np.isfinite(modspec)
+                chiarr = np.square(
+                    (fluxes[cspec][gvals] - modspec[gvals]) * cweights[gvals]
+                )
+                lnl += -0.5 * np.sum(chiarr)
+        return lnl
+
+    def _timer(self, cname):
+        """
+        Timer for a part of the likelihood when this call is profiled
+        """
+        if self._profiling:
+            return self.profiler.timer(cname)
+        return nullcontext()
+
+    def _profiled_lnlike(self, obsdata, modinfo):
+        """
+        Log(likelihood) with the time in each part recorded by the profiler
+
+        Without active pixels, the normalization and chi^2 are done in the same
+        parts as for the active pixels.  This is checked against MEModel.lnlike
+        on the first profiled call, if they differ the normalization and chi^2
+        are only timed together as the remainder.
+        """
+        prof = self.profiler
+        if self.active_modinfo is None and self._full_breakdown is None:
+            full = self._full_lnlike(obsdata, modinfo)
+            direct = super().lnlike(obsdata, modinfo)
+            self._full_breakdown = bool(np.isclose(full, direct, rtol=1e-10))
+            if not self._full_breakdown:
+                print(
+                    "warning: full pixel likelihood differs from MEModel.lnlike, "
+                    "normalization and chi^2 are not timed"
+                )
+        sed_names = ["stellar_sed", "dust_extinguished_sed", "hi_abs_sed"]
+        for cname in sed_names:
+            setattr(self, cname, prof.wrap(cname, getattr(self, cname)))
+        self._profiling = True
+        try:
+            with prof.timer("lnlike"):
+                return self._lnlike(obsdata, modinfo)
+        finally:
+            self._profiling = False
+            for cname in sed_names:
+                delattr(self, cname)
+
+    def use_emulator(self, emulator, modinfo):
+        """
+        Use a PCA emulator of the model grid for the stellar SED
+
+        The emulator is also used for the active pixels if they have been
+        set (not for binned pixels).  The result is compared to the direct
+        grid interpolation for the current parameters and the maximum
+        difference is printed.
+
+        Parameters
+        ----------
+        emulator : GridEmulator
+            emulator built from the model grid
+        modinfo : ModelData
+            model grid
+        """
+        self.emulators = [emulator]
+        if self.active_indxs is not None:
+            self.emulators.append(emulator.subset(self.active_indxs))
+
+        direct = super().stellar_sed(modinfo)
+        emu = self.stellar_sed(modinfo)
+        maxdiff = max(
+            np.nanmax(np.absolute(emu[cspec] / direct[cspec] - 1.0))
+            for cspec in direct.keys()
+        )
+        print(f"emulator: max difference = {100.0 * maxdiff:.3f}%")
+
+    def stellar_sed(self, moddata):
+        """
+        Stellar SED using the emulator when one matches the model grid pixels
+        """
+        emulator = None
+        for cemu in self.emulators:
+            if _matches(cemu.waves, moddata):
+                emulator = cemu
+        if emulator is None:
+            return super().stellar_sed(moddata)
+
+        sed = emulator.sed(
+            self.logTeff.value, self.logg.value, self.logZ.value, self.vturb.value
+        )
+        # shift spectrum for the velocity
+        for cspec in sed.keys():
+            if cspec != "BAND":
+                cwaves = emulator.waves[cspec].value
+                sed[cspec] = np.interp(
+                    cwaves, (1.0 + self.velocity.value / 2.998e5) * cwaves, sed[cspec]
+                )
+        return sed
+
+    def build_dust_basis(self, modinfo, dust_basis=None):
+        """
+        Precompute the wavelength dependent terms of the extinction curve
+
+        The result is compared to the direct calculation for the current
+        parameters and the maximum difference is printed.
+
+        Parameters
+        ----------
+        modinfo : ModelData
+            model grid giving the data wavelengths
+        dust_basis : DustBasis
+            already computed basis for the same model grid (optional)
+        """
+        if dust_basis is None:
+            dust_basis = DustBasis(modinfo)
+        self.dust_basis = dust_basis
+
+        unit_sed = {
+            cspec: np.full(len(modinfo.waves[cspec]), 1.0)
+            for cspec in modinfo.fluxes.keys()
+        }
+        direct = super().dust_extinguished_sed(modinfo, unit_sed)
+        fast = self.dust_extinguished_sed(modinfo, unit_sed)
+        maxdiff = max(
+            np.nanmax(np.absolute(2.5 * np.log10(fast[cspec] / direct[cspec])))
+            for cspec in unit_sed.keys()
+        )
+        print(f"dust basis: max difference = {maxdiff:.2e} mag")
+
+    def dust_extinguished_sed(self, moddata, sed):
+        """
+        Dust extinguished SED using the precomputed basis when it has been built
+        """
+        if self.dust_basis is None or not _matches(self.dust_basis.waves, moddata):
+            return super().dust_extinguished_sed(moddata, sed)
+
+        axav = self.dust_basis.axav(
+            self.Rv.value,
+            self.C2.value,
+            self.B3.value,
+            self.C4.value,
+            self.xo.value,
+            self.gamma.value,
+            self.velocity.value,
+        )
+        return {
+            cspec: sed[cspec] * (10 ** (-0.4 * axav[cspec][0] * self.Av.value))
+            for cspec in sed.keys()
+        }
+
+    def build_lya_table(self, modinfo, dvel=2.0):
+        """
+        Tabulate the Milky Way Lyman-alpha absorption for this star
+
+        The absorption from any other HI component is computed directly,
+        but only when the parameters it depends on change.
+
+        Parameters
+        ----------
+        modinfo : ModelData
+            model grid giving the data wavelengths
+        dvel : float
+            velocity spacing of the table [km/s]
+        """
+        self.lya_table = LyaTable(self, modinfo, dvel=dvel)
+        print(
+            "Ly-alpha table: max transmission error = "
+            f"{self.lya_table.max_error:.2e}"
+        )
+
+        self._hi_unit_sed = {
+            cspec: np.full(len(modinfo.waves[cspec]), 1.0)
+            for cspec in modinfo.fluxes.keys()
+        }
+        self._hi_other_key = None
+
+        # other parameters that change the HI absorption
+        candidates = [
+            cname
+            for cname in self.paramnames
+            if cname not in ["vel_MW", "logHI_MW"]
+            and (cname.startswith("vel") or "HI" in cname)
+        ]
+        ref_trans = self._hi_other_trans(modinfo)
+        self._hi_other_names = []
+        for cname in candidates:
+            param = getattr(self, cname)
+            orig_value = param.value
+            param.value = orig_value + (50.0 if cname.startswith("vel") else 1.0)
+            ctrans = self._hi_other_trans(modinfo)
+            param.value = orig_value
+            if any(np.any(ctrans[cspec] != ref_trans[cspec]) for cspec in ctrans):
+                self._hi_other_names.append(cname)
+
+    def _hi_other_trans(self, moddata):
+        """
+        Transmission of all the HI components except the Milky Way one
+        """
+        logHI_MW = self.logHI_MW.value
+        self.logHI_MW.value = 0.0
+        trans = super().hi_abs_sed(moddata, self._hi_unit_sed)
+        self.logHI_MW.value = logHI_MW
+        return trans
+
+    def hi_abs_sed(self, moddata, sed):
+        """
+        HI absorbed SED using the Lyman-alpha table when it has been built
+        """
+        if self.lya_table is None or not _matches(self.lya_table.waves, moddata):
+            return super().hi_abs_sed(moddata, sed)
+
+        ckey = tuple(getattr(self, cname).value for cname in self._hi_other_names)
+        if ckey != self._hi_other_key:
+            trans = self._hi_other_trans(moddata)
+            self._hi_other = {
+                cspec: ctrans
+                for cspec, ctrans in trans.items()
+                if np.any(ctrans != 1.0)
+            }
+            self._hi_other_key = ckey
+
+        mw_trans = self.lya_table.transmission(self.logHI_MW.value, self.vel_MW.value)
+        hi_sed = {}
+        for cspec in sed.keys():
+            hi_sed[cspec] = np.copy(sed[cspec])
+            if cspec in self._hi_other:
+                hi_sed[cspec] *= self._hi_other[cspec]
+            if cspec in mw_trans:
+                hi_sed[cspec][self.lya_table.indxs[cspec]] *= mw_trans[cspec]
+        return hi_sed
@@ -0,0 +1,368 @@
+import argparse
+import ast
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from importlib import metadata
+
+# fit_model.py options that do not change the fit results
+ignore_options = [
+    "showfit",
+    "nproc",
+    "profile_likelihood",
+    "profile_fraction",
+    "bgwrite",
+    "cache",
+    "cachedir",
+    "cache_size",
+]
+
+# modules in utils used by fit_model.py that do not change the fit results
+ignore_modules = ["fit_cache.py", "like_profile.py"]
+
+# modules in utils only used by fit_model.py through pickled objects
+pickled_modules = ["grid_emulator.py"]
+
+
+def fit_modules(filename="fit_model.py"):
+    """
+    Modules in utils that change the fit results or output files
+
+    These are the modules imported by fit_model.py, directly or through
+    other modules in utils, and the pickled_modules.
+
+    Parameters
+    ----------
+    filename : str
+        module in utils to start from
+
+    Returns
+    -------
+    modules : list of str
+        module file names
+    """
+    utilsdir = os.path.dirname(os.path.abspath(__file__))
+    modules = set(pickled_modules)
+    todo = [filename]
+    while len(todo) > 0:
+        cname = todo.pop()
+        modules.add(cname)
+        with open(os.path.join(utilsdir, cname)) as cfile:
+            tree = ast.parse(cfile.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                inames = [calias.name for calias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                inames = [node.module]
+            else:
+                continue
+            for iname in inames:
+                ifile = f"{iname}.py"
+                if (
+                    os.path.isfile(os.path.join(utilsdir, ifile))
+                    and ifile not in ignore_modules
+                    and ifile not in modules
+                ):
+                    todo.append(ifile)
+    return sorted(modules)
+
+
+def _hash_file(hasher, filename, contents=True):
+    """
+    Add a file to the hash, either the contents or only the size and time
+    """
+    hasher.update(os.path.basename(filename).encode())
+    if not os.path.isfile(filename):
+        hasher.update(b"missing")
+    elif contents:
+        with open(filename, "rb") as cfile:
+            for chunk in iter(lambda: cfile.read(2**20), b""):
+                hasher.update(chunk)
+    else:
+        fstat = os.stat(filename)
+        hasher.update(f"{fstat.st_size} {fstat.st_mtime}".encode())
+
+
+def star_files(starname, path):
+    """
+    Star data file and the spectra files it references
+
+    Parameters
+    ----------
+    starname : str
+        name of the star
+    path : str
+        path to the star data
+
+    Returns
+    -------
+    files : list of str
+        the .dat file followed by the spectra files
+    """
+    datfile = os.path.join(path, f"{starname}.dat")
+    files = [datfile]
+    if not os.path.isfile(datfile):
+        return files
+    for line in open(datfile):
+        line = line.strip()
+        if line.startswith("#") or "=" not in line:
+            continue
+        cval = line.split("=", 1)[1].strip()
+        if cval.endswith(".fits"):
+            candidates = [os.path.join(path, cval), os.path.join(path, "Spectra", cval)]
+            files.append(
+                next((cname for cname in candidates if os.path.isfile(cname)), cval)
+            )
+    return files
+
+
+def grid_files(args):
+    """
+    Files giving the model grid used by fit_model.py
+
+    These can be large, so only their size and modification time are used.
+    """
+    modstr = "wd_hubeny_" if args.modtype == "whitedwarfs" else "tlusty_"
+    if args.gridfile is not None:
+        files = [args.gridfile]
+    elif args.picmodel:
+        files = [f"{modstr}modinfo.p"]
+    else:
+        files = sorted(glob.glob(f"{args.modpath}/{modstr}*.dat"))
+    if args.emulator is not None:
+        files.append(args.emulator)
+    return files
+
+
+def fit_key(args):
+    """
+    Hash of everything that determines the results of a fit_model.py run
+
+    This is the star data and spectra contents, the model grid version, the
+    fit_model.py options, the code of the fit modules in utils (see
+    fit_modules), and the measure_extinction version.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        fit_model.py options
+
+    Returns
+    -------
+    key : str
+        hex digest
+    """
+    hasher = hashlib.sha256()
+    for cfile in star_files(args.starname, args.path):
+        _hash_file(hasher, cfile)
+    for cfile in grid_files(args):
+        _hash_file(hasher, cfile, contents=False)
+    options = {
+        cname: cval for cname, cval in vars(args).items() if cname not in ignore_options
+    }
+    hasher.update(json.dumps(options, sort_keys=True).encode())
+    for cname in fit_modules():
+        _hash_file(hasher, os.path.join(os.path.dirname(__file__), cname))
+    hasher.update(metadata.version("measure_extinction").encode())
+    return hasher.hexdigest()
+
+
+class FitCache(object):
+    """
+    Cache of the output files of fit_model.py runs
+
+    Each entry is a directory named by the fit key with copies of the output
+    files (figs, exts) and an info.json file.  The time of the last use of an
+    entry is the modification time of its info.json file and the least
+    recently used entries are removed when the cache is larger than max_size.
+    Restoring holds a shared lock and evicting an exclusive lock on the
+    cache, so an entry is not removed while another run is restoring it.
+
+    Parameters
+    ----------
+    cachedir : str
+        cache directory
+    max_size : float
+        maximum size of the cache [GB]
+    """
+
+    def __init__(self, cachedir, max_size=20.0):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        os.makedirs(cachedir, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.cachedir, key)
+
+    @contextmanager
+    def _lock(self, exclusive=False):
+        """
+        Lock on the cache directory, shared for reading, exclusive for removing
+        """
+        with open(os.path.join(self.cachedir, ".lock"), "a") as lfile:
+            fcntl.flock(lfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lfile, fcntl.LOCK_UN)
+
+    def restore(self, key):
+        """
+        Copy the output files of a cached fit back to their original location
+
+        Returns
+        -------
+        restored : boolean
+            False if there is no cache entry for key
+        """
+        cdir = self._entry(key)
+        infofile = os.path.join(cdir, "info.json")
+        with self._lock():
+            if not os.path.isfile(infofile):
+                return False
+            info = json.load(open(infofile))
+            for cname in info["files"]:
+                dname = os.path.dirname(cname)
+                if dname != "":
+                    os.makedirs(dname, exist_ok=True)
+                shutil.copy2(os.path.join(cdir, "files", cname), cname)
+            os.utime(infofile)
+        return True
+
+    def store(self, key, starname, files):
+        """
+        Add the output files of a fit to the cache
+
+        Parameters
+        ----------
+        key : str
+            fit key
+        starname : str
+            name of the star
+        files : list of str
+            output files (relative paths)
+        """
+        tmpdir = f"{self._entry(key)}.{os.getpid()}.tmp"
+        for cname in files:
+            os.makedirs(
+                os.path.join(tmpdir, "files", os.path.dirname(cname)), exist_ok=True
+            )
+            shutil.copy2(cname, os.path.join(tmpdir, "files", cname))
+        info = {"star": starname, "created": time.time(), "files": files}
+        json.dump(info, open(os.path.join(tmpdir, "info.json"), "w"))
+        # a complete entry appears in one step, an existing entry is kept
+        try:
+            os.rename(tmpdir, self._entry(key))
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """
+        Cache entries with their size [bytes] and time of last use
+
+        Returns
+        -------
+        entries : list of (key, size, last_used)
+            sorted from the least to the most recently used
+        """
+        entries = []
+        for key in os.listdir(self.cachedir):
+            infofile = os.path.join(self._entry(key), "info.json")
+            if key.endswith(".tmp") or not os.path.isfile(infofile):
+                continue
+            csize = 0
+            for root, dirs, files in os.walk(self._entry(key)):
+                csize += sum(os.path.getsize(os.path.join(root, cf)) for cf in files)
+            entries.append((key, csize, os.path.getmtime(infofile)))
+        return sorted(entries, key=lambda centry: centry[2])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_size
+
+        Returns
+        -------
+        nremoved : int
+            number of entries removed
+        """
+        removed = []
+        with self._lock(exclusive=True):
+            entries = self.entries()
+            tsize = sum(centry[1] for centry in entries)
+            for key, csize, cused in entries:
+                if tsize <= self.max_size * 1e9:
+                    break
+                # renamed entries are no longer seen by other runs
+                cname = f"{self._entry(key)}.{os.getpid()}.evict.tmp"
+                os.rename(self._entry(key), cname)
+                removed.append(cname)
+                tsize -= csize
+        for cname in removed:
+            shutil.rmtree(cname, ignore_errors=True)
+        return len(removed)
+
+    def log(self, starname, key, status):
+        """
+        Record if a fit was restored from the cache or recomputed
+        """
+        with open(os.path.join(self.cachedir, "cache_log.txt"), "a") as lfile:
+            lfile.write(f"{time.time():.1f} {starname} {status} {key}\n")
+
+    def report(self, since=None):
+        """
+        Print the last status of each star
+
+        Parameters
+        ----------
+        since : float
+            only include fits after this time [s since the epoch]
+        """
+        logfile = os.path.join(self.cachedir, "cache_log.txt")
+        status = {}
+        if os.path.isfile(logfile):
+            for line in open(logfile):
+                ctime, starname, cstatus, key = line.split()
+                if since is None or float(ctime) >= since:
+                    status[starname] = cstatus
+        hits = sorted(cname for cname, cval in status.items() if cval == "hit")
+        misses = sorted(cname for cname, cval in status.items() if cval != "hit")
+        print(f"cache hits ({len(hits)}): {" ".join(hits)}")
+        print(f"recomputed ({len(misses)}): {" ".join(misses)}")
+        entries = self.entries()
+        print(
+            f"cache: {len(entries)} entries, "
+            f"{sum(centry[1] for centry in entries) / 1e9:.2f} GB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cachedir", help="cache directory", default="./cache/")
+    parser.add_argument(
+        "--cache_size", help="maximum cache size [GB]", default=20.0, type=float
+    )
+    parser.add_argument(
+        "--since", help="only report fits in the last N hours", default=None, type=float
+    )
+    parser.add_argument(
+        "--evict", help="remove entries to fit in the cache size", action="store_true"
+    )
+    args = parser.parse_args()
+
+    cache = FitCache(args.cachedir, max_size=args.cache_size)
+    if args.evict:
+        print(f"{cache.evict()} entries removed")
+    since = None
+    if args.since is not None:
+        since = time.time() - args.since * 3600.0
+    cache.report(since=since)
+
+
+if __name__ == "__main__":
+    main()
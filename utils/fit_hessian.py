@@ -0,0 +1,165 @@
+import copy
+from multiprocessing import Pool
+
+import numpy as np
+
+from measure_extinction.model import MEModel
+
+# model and data used by the worker processes, set once per worker
+_worker_info = {}
+
+
+def _init_worker(memod, obsdata, modinfo):
+    """
+    Store a private copy of the model and the data in each worker process
+    """
+    _worker_info["memod"] = copy.deepcopy(memod)
+    _worker_info["obsdata"] = obsdata
+    _worker_info["modinfo"] = modinfo
+
+
+def _worker_lnprob(params):
+    """
+    Log(posterior) for one set of fit parameters in a worker process
+    """
+    return MEModel.lnprob(
+        params,
+        _worker_info["memod"],
+        _worker_info["obsdata"],
+        _worker_info["modinfo"],
+    )
+
+
+def get_fit_names(memod):
+    """
+    Names of the parameters that are not fixed, in the order used by
+    MEModel.fit_to_parameters
+    """
+    return [cname for cname in memod.paramnames if not getattr(memod, cname).fixed]
+
+
+def hessian_uncertainties(memod, obsdata, modinfo, relstep=1e-3, nproc=1):
+    """
+    Estimate the parameter uncertainties from the Hessian of the log(posterior)
+
+    The Hessian is computed with central finite differences around the current
+    parameter values (usually the minimizer result) and the covariance matrix
+    is the inverse of the negative Hessian.  If the negative Hessian is not
+    positive definite, the covariance is diagonal using the curvature of each
+    parameter alone, or the parameter range if that is not positive.
+
+    Parameters
+    ----------
+    memod : MEModel
+        model with the best fit parameters
+    obsdata : StarData
+        observed data
+    modinfo : ModelData
+        model grid
+    relstep : float
+        finite difference step as a fraction of the parameter value, with a
+        floor of relstep times the parameter range for values near zero
+    nproc : int
+        number of processes used to evaluate the log(posterior)
+
+    Returns
+    -------
+    outmod : MEModel
+        copy of the model with the uncertainties set
+    covar : ndarray
+        covariance matrix of the fit parameters
+    """
+    names = get_fit_names(memod)
+    x0 = np.array([getattr(memod, cname).value for cname in names], dtype=float)
+    nparams = len(x0)
+
+    # parameter scale: the range between the bounds, otherwise the value
+    scales = np.maximum(np.absolute(x0), 1.0)
+    for k, cname in enumerate(names):
+        bounds = getattr(memod, cname).bounds
+        if (
+            bounds is not None
+            and bounds[0] is not None
+            and bounds[1] is not None
+            and bounds[1] > bounds[0]
+        ):
+            scales[k] = bounds[1] - bounds[0]
+    steps = np.maximum(relstep * np.absolute(x0), relstep * scales)
+
+    # parameters at or near a bound (e.g., A(V) = 0) are moved inside by
+    # one step so that the central differences are defined
+    center = np.copy(x0)
+    for k, cname in enumerate(names):
+        bounds = getattr(memod, cname).bounds
+        if bounds is not None:
+            lo = bounds[0] + steps[k] if bounds[0] is not None else -np.inf
+            hi = bounds[1] - steps[k] if bounds[1] is not None else np.inf
+            center[k] = np.clip(center[k], lo, hi)
+
+    # all the points needed for the central differences
+    offsets = [np.zeros(nparams)]
+    for i in range(nparams):
+        for si in [1.0, -1.0]:
+            coff = np.zeros(nparams)
+            coff[i] = si * steps[i]
+            offsets.append(coff)
+    for i in range(nparams):
+        for j in range(i + 1, nparams):
+            for si, sj in [(1.0, 1.0), (1.0, -1.0), (-1.0, 1.0), (-1.0, -1.0)]:
+                coff = np.zeros(nparams)
+                coff[i] = si * steps[i]
+                coff[j] = sj * steps[j]
+                offsets.append(coff)
+    points = [center + coff for coff in offsets]
+
+    if nproc > 1:
+        with Pool(
+            processes=nproc,
+            initializer=_init_worker,
+            initargs=(memod, obsdata, modinfo),
+        ) as pool:
+            lnps = pool.map(_worker_lnprob, points)
+    else:
+        _init_worker(memod, obsdata, modinfo)
+        lnps = [_worker_lnprob(cpoint) for cpoint in points]
+    lnps = np.array(lnps)
+
+    if not np.all(np.isfinite(lnps)):
+        print("warning: non-finite log(posterior) values in the Hessian stencil")
+
+    # unpack the values in the same order as the offsets were generated
+    f0 = lnps[0]
+    fdiag = lnps[1 : 2 * nparams + 1].reshape(nparams, 2)
+    hess = np.zeros((nparams, nparams))
+    for i in range(nparams):
+        hess[i, i] = (fdiag[i, 0] - 2.0 * f0 + fdiag[i, 1]) / steps[i] ** 2
+    k = 2 * nparams + 1
+    for i in range(nparams):
+        for j in range(i + 1, nparams):
+            fpp, fpm, fmp, fmm = lnps[k : k + 4]
+            hess[i, j] = (fpp - fpm - fmp + fmm) / (4.0 * steps[i] * steps[j])
+            hess[j, i] = hess[i, j]
+            k += 4
+
+    # the covariance is the inverse of the negative Hessian
+    if np.all(np.linalg.eigvalsh(-hess) > 0.0):
+        covar = np.linalg.inv(-hess)
+    else:
+        print(
+            "warning: Hessian is not negative definite, "
+            "using diagonal uncertainties without correlations"
+        )
+        curv = -np.diag(hess)
+        # a uniform distribution over the range if there is no curvature
+        variances = scales**2 / 12.0
+        gvals = curv > 0.0
+        variances[gvals] = 1.0 / curv[gvals]
+        for cname in np.array(names)[~gvals]:
+            print(f"warning: no curvature for {cname}, using its range")
+        covar = np.diag(variances)
+    uncs = np.sqrt(np.diag(covar))
+
+    outmod = copy.deepcopy(memod)
+    outmod.fit_to_parameters(x0, uncs=uncs)
+
+    return outmod, covar
@@ -0,0 +1,318 @@
+import argparse
+import io
+import os
+import shlex
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import Manager
+
+import matplotlib
+import matplotlib.pyplot as plt
+from astropy.table import Table
+
+from fit_model import fit_model_parser, fit_star, read_models
+from grid_file import load_grid
+from output_writer import OutputWriter
+from results_catalog import read_extfile, column_array
+
+# model grid for each worker process, read once by the main process
+_worker_modinfo = None
+# output writer for each worker process, the outputs of a star are written
+# while the next star is fit
+_worker_writer = None
+
+
+def _parse_options(starname, options):
+    """
+    fit_model.py options for one star
+    """
+    return fit_model_parser().parse_args([starname] + shlex.split(options))
+
+
+def _init_worker(modinfo):
+    global _worker_modinfo, _worker_writer
+    os.environ["OMP_NUM_THREADS"] = "1"
+    # figures are only written to files
+    matplotlib.use("Agg")
+    _worker_modinfo = modinfo
+    _worker_writer = OutputWriter(background=True)
+
+
+def _fit_star_worker(starname, options, logdir):
+    """
+    Fit one star with the grid of this worker, the output goes to the log file
+    """
+    start_time = time.time()
+    # the band names are set for each star when the curve is saved
+    band_names = _worker_modinfo.band_names
+    os.makedirs(logdir, exist_ok=True)
+    with open(os.path.join(logdir, f"{starname}.log"), "w") as lfile:
+        with redirect_stdout(lfile), redirect_stderr(lfile):
+            try:
+                fit_star(
+                    _parse_options(starname, options),
+                    modinfo=_worker_modinfo,
+                    writer=_worker_writer,
+                )
+                status = "done"
+            except (Exception, SystemExit) as err:
+                traceback.print_exc()
+                status = f"failed: {err!r}"
+            finally:
+                _worker_modinfo.band_names = band_names
+                plt.close("all")
+    return {"star": starname, "status": status, "runtime": time.time() - start_time}
+
+
+def _flush_worker(barrier, close):
+    """
+    Wait for the outputs of this worker and check them, close stops the
+    background writer
+    """
+    with redirect_stdout(io.StringIO()):
+        if close:
+            _worker_writer.close()
+        else:
+            _worker_writer.flush()
+    failures = _worker_writer.failures
+    _worker_writer.failures = {}
+    # wait for the other workers so each worker is flushed once
+    barrier.wait()
+    return failures
+
+
+class FitPool(object):
+    """
+    Local process pool for fit_model.py fits
+
+    The model grid is read once when the pool is made and each worker uses it
+    for all the stars it fits, so the pool can be kept (e.g., in a notebook)
+    and used for several sets of stars.  The outputs are written to figs/ and
+    exts/ as for fit_model.py and the output of each fit to logdir/{star}.log.
+    Each worker writes the outputs of a star in the background while it fits
+    the next star, flush waits for all the fits and outputs and checks them.
+
+    Parameters
+    ----------
+    options : str
+        fit_model.py options (e.g., "--gridfile=wd_hubeny_grid.h5 --mcmc"),
+        the grid options are used for all the fits
+    nproc : int
+        number of worker processes
+    logdir : str
+        directory for the log files
+    """
+
+    def __init__(self, options="", nproc=4, logdir="logs"):
+        self.options = options
+        self.nproc = nproc
+        self.logdir = logdir
+        # fits not yet waited for by flush
+        self.futures = []
+        # the grid file spectra are only read by the workers when used
+        args = _parse_options("grid", options)
+        if args.gridfile is not None:
+            modinfo = load_grid(args.gridfile)
+        else:
+            modinfo = read_models(args.modtype, args.modpath, args.picmodel)
+        self.executor = ProcessPoolExecutor(
+            max_workers=nproc, initializer=_init_worker, initargs=(modinfo,)
+        )
+
+    def submit(self, starnames, options=None):
+        """
+        Submit one fit for each star
+
+        Parameters
+        ----------
+        starnames : list of str
+            stars to fit
+        options : str
+            fit_model.py options, default is the options of the pool, the grid
+            options are ignored
+
+        Returns
+        -------
+        futures : dict
+            concurrent.futures.Future for each star, the result is a dict with
+            the star, status, and runtime
+        """
+        if options is None:
+            options = self.options
+        futures = {
+            starname: self.executor.submit(
+                _fit_star_worker, starname, options, self.logdir
+            )
+            for starname in starnames
+        }
+        self.futures += list(futures.values())
+        return futures
+
+    def flush(self, close=False):
+        """
+        Wait for the submitted fits and the outputs of all the workers
+
+        Parameters
+        ----------
+        close : boolean
+            set to also stop the background writers of the workers
+
+        Returns
+        -------
+        failures : dict
+            problem for each output file that failed
+        """
+        # all the workers are idle once the fits are done, so each one takes
+        # one of the flush tasks
+        wait(self.futures)
+        self.futures = []
+        failures = {}
+        with Manager() as manager:
+            # one task for each worker, each waits until all have started
+            barrier = manager.Barrier(self.nproc)
+            futures = [
+                self.executor.submit(_flush_worker, barrier, close)
+                for k in range(self.nproc)
+            ]
+            for cfuture in futures:
+                failures.update(cfuture.result())
+        return failures
+
+    def close(self):
+        """
+        Stop the worker processes after the submitted fits are done
+
+        Returns
+        -------
+        failures : dict
+            problem for each output file that failed since the last flush
+        """
+        failures = self.flush(close=True)
+        self.executor.shutdown()
+        return failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def gather_results(futures, extpath="./exts/", progress=True, pool=None):
+    """
+    Wait for the fits and collect the results in one table
+
+    Parameters
+    ----------
+    futures : dict
+        future for each star (from FitPool.submit)
+    extpath : str
+        path to the extinction curve files
+    progress : boolean
+        set to print each star as its fit finishes
+    pool : FitPool
+        pool that ran the fits, its outputs are flushed and checked before
+        the extinction curves are read
+
+    Returns
+    -------
+    results : astropy Table
+        one row for each star with the status, runtime, and the final fit
+        parameters (MCMC if run, otherwise HESS or MIN)
+    """
+    stars = {cfuture: starname for starname, cfuture in futures.items()}
+    rows = {}
+    for k, cfuture in enumerate(as_completed(stars.keys())):
+        starname = stars[cfuture]
+        try:
+            crow = cfuture.result()
+        except Exception as err:
+            crow = {"star": starname, "status": f"failed: {err!r}"}
+        rows[starname] = crow
+        if progress:
+            print(
+                f"{k + 1} of {len(futures)}: {starname} {crow['status']}"
+                f" ({crow.get('runtime', 0.0):.0f} seconds)"
+            )
+
+    failures = pool.flush() if pool is not None else {}
+    for cname, message in failures.items():
+        print(f"output failed: {cname} ({message})")
+
+    # in the order the stars were submitted
+    rows = [rows[starname] for starname in futures.keys()]
+    for crow in rows:
+        nfailed = sum(
+            os.path.basename(cname).startswith(f"{crow['star']}_")
+            for cname in failures.keys()
+        )
+        if crow["status"] == "done" and nfailed > 0:
+            crow["status"] = f"failed: {nfailed} output files"
+        extfile = os.path.join(extpath, f"{crow['star']}_mefit_ext.fits")
+        if crow["status"] == "done" and os.path.isfile(extfile):
+            # the last fit type is the final one
+            crow.update(read_extfile(extfile)[-1])
+    colnames = ["star", "status", "runtime"]
+    for crow in rows:
+        colnames += [cname for cname in crow.keys() if cname not in colnames]
+    results = Table()
+    for cname in colnames:
+        cvals = column_array(rows, cname)
+        results[cname] = cvals.astype(str) if cvals.dtype == object else cvals
+    return results
+
+
+def fit_many(starnames, options="", nproc=4, logdir="logs", progress=True):
+    """
+    Fit stars in parallel and collect the results in one table
+
+    Parameters
+    ----------
+    starnames : list of str
+        stars to fit
+    options : str
+        fit_model.py options (e.g., "--gridfile=wd_hubeny_grid.h5 --mcmc")
+    nproc : int
+        number of worker processes
+    logdir : str
+        directory for the log files
+    progress : boolean
+        set to print each star as its fit finishes
+
+    Returns
+    -------
+    results : astropy Table
+        one row for each star (see gather_results)
+    """
+    with FitPool(options, nproc=nproc, logdir=logdir) as pool:
+        futures = pool.submit(starnames)
+        return gather_results(futures, progress=progress, pool=pool)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("starnames", nargs="+", help="names of stars")
+    parser.add_argument(
+        "--options",
+        help='fit_model.py options, e.g., --options="--picmodel --mcmc"',
+        default="",
+    )
+    parser.add_argument(
+        "--nproc", help="number of stars fit in parallel", default=4, type=int
+    )
+    parser.add_argument(
+        "--outfile", help="results table", default="./exts/fit_many.ecsv"
+    )
+    args = parser.parse_args()
+
+    start_time = time.time()
+    results = fit_many(args.starnames, options=args.options, nproc=args.nproc)
+    results.write(args.outfile, overwrite=True)
+    print(f"results in {args.outfile}")
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
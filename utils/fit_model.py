@@ -1,4 +1,5 @@
 import argparse
+import copy
 import glob
 import pickle
 import time
@@ -9,11 +10,17 @@ import astropy.units as u
 from measure_extinction.stardata import StarData
 from measure_extinction.extdata import ExtData
 from measure_extinction.modeldata import ModelData
-from measure_extinction.model import MEModel
 
-import os
+from fit_hessian import hessian_uncertainties, get_fit_names
+from fast_model import FastMEModel
+from grid_file import load_grid
+from fit_cache import FitCache, fit_key
+from like_profile import LikelihoodProfiler
+from chain_plots import fast_sampler_plots
+from output_writer import OutputWriter
+from samplers import move_types, fit_sampler_moves, sampling_efficiency, cpu_time
 
-os.environ["OMP_NUM_THREADS"] = "1"
+import os
 
 
 def fit_model_parser():
@@ -44,54 +51,127 @@ def fit_model_parser():
         help="Set to read model grid from pickle file",
         action="store_true",
     )
+    parser.add_argument(
+        "--gridfile",
+        help="combined grid file (from pic_cont.py), only needed spectra are read",
+        default=None,
+    )
+    parser.add_argument(
+        "--emulator",
+        help="pickle file with the PCA emulator of the model grid (from pic_cont.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--binfac",
+        help="bin the spectra by this factor for a first minimizer fit",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--activepix",
+        help="only compute the model for the pixels used in the fit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dustbasis",
+        help="use precomputed extinction curve terms",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lyatable",
+        help="use a precomputed Ly-alpha absorption table for the MW HI",
+        action="store_true",
+    )
     parser.add_argument(
         "--Av_init", help="initial A(V) for fitting", default=0.2, type=float
     )
+    parser.add_argument(
+        "--hessian",
+        help="estimate uncertainties from the Hessian at the minimizer result",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--nproc", help="number of processes for parallel steps", default=4, type=int
+    )
     parser.add_argument("--mcmc", help="run EMCEE MCMC fitting", action="store_true")
     parser.add_argument(
         "--mcmc_nsteps", help="number of MCMC steps", default=1000, type=int
     )
+    parser.add_argument(
+        "--mcmc_moves",
+        help="MCMC move set, gaussian uses the Hessian covariance if --hessian is set",
+        choices=move_types,
+        default="stretch",
+    )
+    parser.add_argument(
+        "--mcmc_burnin",
+        help="number of steps to estimate the covariance for gaussian moves",
+        default=1000,
+        type=int,
+    )
+    parser.add_argument(
+        "--mcmc_ntemps",
+        help="number of parallel tempering temperatures, 1 for no tempering",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--mcmc_tmax", help="highest tempering temperature", default=10.0, type=float
+    )
+    parser.add_argument(
+        "--fastplots",
+        help="make the MCMC chain and corner plots from binned summaries of the chains",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bgwrite",
+        help="write the figures and extinction curve in a background process",
+        action="store_true",
+    )
     parser.add_argument(
         "--showfit", help="display the best fit model plot", action="store_true"
     )
+    parser.add_argument(
+        "--profile_likelihood",
+        help="time the parts of a sample of the likelihood calls, results in logs/",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile_fraction",
+        help="fraction of the likelihood calls to time",
+        default=0.01,
+        type=float,
+    )
+    parser.add_argument(
+        "--cache",
+        help="restore the outputs of an identical previous fit instead of fitting",
+        action="store_true",
+    )
+    parser.add_argument("--cachedir", help="fit cache directory", default="./cache/")
+    parser.add_argument(
+        "--cache_size", help="maximum fit cache size [GB]", default=20.0, type=float
+    )
     return parser
 
 
-def main():
-    parser = fit_model_parser()
-    args = parser.parse_args()
-
-    outname = f"figs/{args.starname}_mefit"
-    resid_range = 20.0
-    lyaplot = True
-    rel_band = "WFC3_F475W"
-
-    # WISCI
-    # only_bands = ["B", "V", "R", "I", "J", "H", "K"]
-    # only_bands = ["J", "H", "K"]
-    only_bands = None
-
-    # get data
-    fstarname = f"{args.starname}.dat"
-    reddened_star = StarData(fstarname, path=f"{args.path}", only_bands=only_bands)
-
-    if "BAND" not in reddened_star.data.keys():
-        rel_band = 0.55 * u.micron
-
-    # remove low S/N STIS data - affected by systematics
-    # sn_cut = 1.5
-    # snr = reddened_star.data["STIS"].fluxes / reddened_star.data["STIS"].uncs
-    # bvals = np.logical_and(
-    #     snr < sn_cut, reddened_star.data["STIS"].waves > 0.17 * u.micron
-    # )
-    # reddened_star.data["STIS"].npts[bvals] = 0
-    # reddened_star.data["STIS"].fluxes[bvals] = 0
-
-    if "BAND" in reddened_star.data.keys():
-        band_names = reddened_star.data["BAND"].get_band_names()
-    else:
-        band_names = []
-    # data_names = list(reddened_star.data.keys())
+def read_models(modtype, modpath, picmodel):
+    """
+    Read the model grid, either from the model files or the pickle file
+
+    Parameters
+    ----------
+    modtype : str
+        type of model grid ("obstars" or "whitedwarfs")
+    modpath : str
+        path to the model files
+    picmodel : boolean
+        set to read the model grid from the pickle file
+
+    Returns
+    -------
+    modinfo : ModelData
+        model grid
+    """
     data_names = [
         "BAND",
         "STIS_G140L",
@@ -106,15 +186,15 @@ def main():
     # model data
     start_time = time.time()
     print("reading model files")
-    if args.modtype == "whitedwarfs":
+    if modtype == "whitedwarfs":
         modstr = "wd_hubeny_"
     else:
         modstr = "tlusty_"
 
-    if args.picmodel:
+    if picmodel:
         modinfo = pickle.load(open(f"{modstr}modinfo.p", "rb"))
     else:
-        tlusty_models_fullpath = glob.glob(f"{args.modpath}/{modstr}*.dat")
+        tlusty_models_fullpath = glob.glob(f"{modpath}/{modstr}*.dat")
         tlusty_models = [
             tfile[tfile.rfind("/") + 1 : len(tfile)] for tfile in tlusty_models_fullpath
         ]
@@ -126,7 +206,7 @@ def main():
         # get the models with just the reddened star band data and spectra
         modinfo = ModelData(
             tlusty_models,
-            path=f"{args.modpath}/",
+            path=f"{modpath}/",
             band_names=band_names,
             spectra_names=data_names,
         )
@@ -134,9 +214,34 @@ def main():
     print("finished reading model files")
     print("--- %s seconds ---" % (time.time() - start_time))
 
+    return modinfo
+
+
+def setup_model(reddened_star, modinfo, modtype, Av_init, wind):
+    """
+    Setup the MEModel for a star including the priors from the star data file
+
+    Parameters
+    ----------
+    reddened_star : StarData
+        observed data
+    modinfo : ModelData
+        model grid
+    modtype : str
+        type of model grid ("obstars" or "whitedwarfs")
+    Av_init : float
+        initial A(V)
+    wind : boolean
+        set to add the IR wind emission model
+
+    Returns
+    -------
+    memod : FastMEModel
+        model ready for fitting
+    """
     # setup the model
     # memod = MEModel(modinfo=modinfo, obsdata=reddened_star)  # use to activate logf fitting
-    memod = MEModel(modinfo=modinfo, obsdata=reddened_star)
+    memod = FastMEModel(modinfo=modinfo, obsdata=reddened_star)
 
     if "Teff" in reddened_star.model_params.keys():
         memod.logTeff.value = np.log10(float(reddened_star.model_params["Teff"]))
@@ -168,18 +273,18 @@ def main():
     memod.exclude_regions = [memod.exclude_regions[0]]
     memod.fit_weights(reddened_star)
 
-    if args.modtype == "whitedwarfs":
+    if modtype == "whitedwarfs":
         memod.vturb.value = 0.0
         memod.vturb.fixed = True
         memod.Av.value = 0.5
         # memod.weights["BAND"] *= 10.0
         # memod.weights["STIS"] *= 10.0
-    if args.wind:
+    if wind:
         memod.windamp.value = 1e-3
         memod.windamp.fixed = False
         memod.windalpha.fixed = False
 
-    memod.Av.value = args.Av_init
+    memod.Av.value = Av_init
     memod.logHI_MW.value = np.log10(1.61e20 * memod.Av.value)
 
     # set velocities to non-zero to help fitting
@@ -196,8 +301,150 @@ def main():
 
     memod.set_initial_norm(reddened_star, modinfo)
 
+    return memod
+
+
+def save_ext_curve(
+    memod,
+    modinfo,
+    reddened_star,
+    reddened_star_full,
+    rel_band,
+    dust_columns,
+    fit_params,
+    extfile,
+    writer=None,
+):
+    """
+    Compute the extinction curve using the best fit stellar SED and save it
+
+    Parameters
+    ----------
+    memod : MEModel
+        best fit model
+    modinfo : ModelData
+        model grid
+    reddened_star : StarData
+        observed data used in the fit, gives the band names
+    reddened_star_full : StarData
+        observed data with all the possible spectra
+    rel_band : str or astropy.Quantity
+        band or wavelength the curve is relative to
+    dust_columns : dict
+        AV and RV values and uncertainties
+    fit_params : dict
+        fit parameter tables
+    extfile : str
+        name of the extinction curve file
+    writer : OutputWriter
+        writer for the extinction curve file (optional)
+    """
+    # create a stardata object with the best intrinsic (no extinction) model
+    modsed = memod.stellar_sed(modinfo)
+    # the grid may be used for other stars, so its band names are restored
+    band_names = modinfo.band_names
+    if "BAND" in reddened_star.data.keys():
+        modinfo.band_names = reddened_star.data["BAND"].get_band_names()
+    modsed_stardata = modinfo.SED_to_StarData(modsed)
+    modinfo.band_names = band_names
+
+    # create an extincion curve and save it
+    extdata = ExtData()
+    extdata.calc_elx(reddened_star_full, modsed_stardata, rel_band=rel_band)
+    extdata.columns = dust_columns
+    if writer is not None:
+        writer.save(extdata, extfile, fit_params=fit_params)
+    else:
+        extdata.save(extfile, fit_params=fit_params)
+
+
+def fit_star(args, modinfo=None, writer=None):
+    """
+    Fit one star and write the figures and extinction curve
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        fit_model.py options (see fit_model_parser)
+    modinfo : ModelData
+        model grid already read, default is to read it as set by the options
+    writer : OutputWriter
+        writer shared by a batch of fits, the outputs are flushed and checked
+        by the batch (e.g., fit_many.py), default is a writer for this fit
+    """
+    outname = f"figs/{args.starname}_mefit"
+    resid_range = 20.0
+    lyaplot = True
+    rel_band = "WFC3_F475W"
+
+    # WISCI
+    # only_bands = ["B", "V", "R", "I", "J", "H", "K"]
+    # only_bands = ["J", "H", "K"]
+    only_bands = None
+
+    # get data
+    fstarname = f"{args.starname}.dat"
+    reddened_star = StarData(fstarname, path=f"{args.path}", only_bands=only_bands)
+
+    if "BAND" not in reddened_star.data.keys():
+        rel_band = 0.55 * u.micron
+
+    if args.cache:
+        cache = FitCache(args.cachedir, max_size=args.cache_size)
+        fitkey = fit_key(args)
+        if cache.restore(fitkey):
+            print(
+                f"{args.starname}: identical fit found, outputs restored from the cache"
+            )
+            cache.log(args.starname, fitkey, "hit")
+            return
+        run_start = time.time()
+
+    # remove low S/N STIS data - affected by systematics
+    # sn_cut = 1.5
+    # snr = reddened_star.data["STIS"].fluxes / reddened_star.data["STIS"].uncs
+    # bvals = np.logical_and(
+    #     snr < sn_cut, reddened_star.data["STIS"].waves > 0.17 * u.micron
+    # )
+    # reddened_star.data["STIS"].npts[bvals] = 0
+    # reddened_star.data["STIS"].fluxes[bvals] = 0
+
+    # model data
+    if modinfo is not None:
+        print("using the model grid already read")
+    elif args.gridfile is not None:
+        modinfo = load_grid(
+            args.gridfile,
+            keys=list(reddened_star.data.keys()) + ["MODEL_FULL_LOWRES"],
+        )
+    else:
+        modinfo = read_models(args.modtype, args.modpath, args.picmodel)
+
+    # setup the model
+    memod = setup_model(reddened_star, modinfo, args.modtype, args.Av_init, args.wind)
+    if args.activepix:
+        memod.set_active_pixels(reddened_star, modinfo)
+        fastinfo = memod.active_modinfo
+    else:
+        fastinfo = modinfo
+    if args.emulator is not None:
+        memod.use_emulator(pickle.load(open(args.emulator, "rb")), modinfo)
+    if args.dustbasis:
+        memod.build_dust_basis(fastinfo)
+    if args.lyatable:
+        memod.build_lya_table(fastinfo)
+    if args.profile_likelihood:
+        memod.profiler = LikelihoodProfiler(fraction=args.profile_fraction)
+
+    # writes the figures and extinction curve, in the background if requested
+    own_writer = writer is None
+    if own_writer:
+        writer = OutputWriter(background=args.bgwrite)
+
     # dictonary for fit parameter tables
     fit_params = {}
+    # run information saved with each fit parameter table
+    run_info = {"DATAPATH": args.path, "MODTYPE": args.modtype}
 
     print("initial parameters")
     memod.pprint_parameters()
@@ -206,28 +453,77 @@ def main():
     # plt.show()
     # exit()
 
+    if args.binfac > 1:
+        start_time = time.time()
+        print(f"starting binned fitting, binfac = {args.binfac}")
+
+        binmod = copy.deepcopy(memod)
+        binmod.set_binned_pixels(reddened_star, modinfo, args.binfac)
+        binfitmod, result = binmod.fit_minimizer(reddened_star, modinfo, maxiter=10000)
+
+        print("finished binned fitting")
+        print("--- %s seconds ---" % (time.time() - start_time))
+        print(result["message"])
+
+        # start the full resolution fit at the binned fit parameters
+        memod.fit_to_parameters(
+            [getattr(binfitmod, cname).value for cname in get_fit_names(memod)]
+        )
+
     start_time = time.time()
     print("starting fitting")
 
     fitmod, result = memod.fit_minimizer(reddened_star, modinfo, maxiter=10000)
 
     print("finished fitting")
-    print("--- %s seconds ---" % (time.time() - start_time))
+    run_time = time.time() - start_time
+    print("--- %s seconds ---" % run_time)
     # check the fit output
     print(result["message"])
 
     print("best parameters")
     fitmod.pprint_parameters()
     fit_params["MIN"] = fitmod.save_parameters()
+    fit_params["MIN"].meta.update(run_info, RUNTIME=run_time)
+
+    if args.binfac > 1:
+        print("parameter shift between binned and full resolution fits")
+        print(f"{'name':>12s} {'binned':>12s} {'full':>12s} {'shift':>12s}")
+        for cname in get_fit_names(fitmod):
+            bval = getattr(binfitmod, cname).value
+            fval = getattr(fitmod, cname).value
+            print(f"{cname:>12s} {bval:12.5g} {fval:12.5g} {fval - bval:12.5g}")
 
     dust_columns = {"AV": (fitmod.Av.value, 0.0), "RV": (fitmod.Rv.value, 0.0)}
 
     fitmod.plot(reddened_star, modinfo, resid_range=resid_range, lyaplot=lyaplot)
-    plt.savefig(f"{outname}_minimizer.pdf")
-    plt.savefig(f"{outname}_minimizer.png")
-    plt.close()
+    writer.savefig(plt.gcf(), [f"{outname}_minimizer.pdf", f"{outname}_minimizer.png"])
+
+    if args.hessian:
+        start_time = time.time()
+        print("computing Hessian uncertainties")
+
+        fitmod_hess, covar = hessian_uncertainties(
+            fitmod, reddened_star, modinfo, nproc=args.nproc
+        )
+
+        print("finished Hessian")
+        run_time = time.time() - start_time
+        print("--- %s seconds ---" % run_time)
+
+        print("Hessian parameters")
+        fitmod_hess.pprint_parameters()
+        fit_params["HESS"] = fitmod_hess.save_parameters()
+        fit_params["HESS"].meta.update(run_info, RUNTIME=run_time)
+
+        dust_columns = {
+            "AV": (fitmod_hess.Av.value, fitmod_hess.Av.unc),
+            "RV": (fitmod_hess.Rv.value, fitmod_hess.Rv.unc),
+        }
 
     if args.mcmc:
+        start_time = time.time()
+        cpu_start = cpu_time()
         print("starting sampling")
 
         # set the A(V) to >0 to allow mcmc to do a better job of fitting
@@ -237,18 +533,48 @@ def main():
 
         # using an MCMC sampler to define nD probability function
         # use best fit result as the starting point
-        fitmod2, flat_samples, sampler = fitmod.fit_sampler(
-            reddened_star,
-            modinfo,
-            nsteps=args.mcmc_nsteps,
-            save_samples=f"{outname.replace("figs", "exts")}_.h5",
-        )
+        if args.mcmc_moves == "stretch" and args.mcmc_ntemps == 1:
+            fitmod2, flat_samples, sampler = fitmod.fit_sampler(
+                reddened_star,
+                modinfo,
+                nsteps=args.mcmc_nsteps,
+                save_samples=f"{outname.replace("figs", "exts")}_.h5",
+            )
+        else:
+            fitmod2, flat_samples, sampler = fit_sampler_moves(
+                fitmod,
+                reddened_star,
+                modinfo,
+                nsteps=args.mcmc_nsteps,
+                movetype=args.mcmc_moves,
+                covar=covar if args.hessian else None,
+                nburnin=args.mcmc_burnin,
+                ntemps=args.mcmc_ntemps,
+                tmax=args.mcmc_tmax,
+                save_samples=f"{outname.replace("figs", "exts")}_.h5",
+            )
 
         print("finished sampling")
+        run_time = time.time() - start_time
+        print("--- %s seconds ---" % run_time)
+        cpu_hours = (cpu_time() - cpu_start) / 3600.0
+        ess, ess_per_hour = sampling_efficiency(sampler, cpu_hours)
+        print(
+            f"effective samples: {ess:.0f}, {ess_per_hour:.0f} per CPU-hour "
+            f"({args.mcmc_moves} moves, {args.mcmc_ntemps} temperatures)"
+        )
 
         print("p50 parameters")
         fitmod2.pprint_parameters()
         fit_params["MCMC"] = fitmod2.save_parameters()
+        fit_params["MCMC"].meta.update(
+            run_info,
+            RUNTIME=run_time,
+            MOVES=args.mcmc_moves,
+            NTEMPS=args.mcmc_ntemps,
+            MINESS=ess,
+            CPUHOUR=cpu_hours,
+        )
 
         dust_columns = {
             "AV": (fitmod2.Av.value, fitmod2.Av.unc),
@@ -256,40 +582,83 @@ def main():
         }
 
         fitmod2.plot(reddened_star, modinfo, resid_range=resid_range, lyaplot=lyaplot)
-        plt.savefig(f"{outname}_mcmc.pdf")
-        plt.savefig(f"{outname}_mcmc.png")
-        plt.close()
-
-        fitmod2.plot_sampler_chains(sampler)
-        plt.savefig(f"{outname}_mcmc_chains.pdf")
-        plt.savefig(f"{outname}_mcmc_chains.png")
-        plt.close()
+        writer.savefig(plt.gcf(), [f"{outname}_mcmc.pdf", f"{outname}_mcmc.png"])
+
+        if args.fastplots:
+            fast_sampler_plots(
+                f"{outname.replace("figs", "exts")}_.h5",
+                get_fit_names(fitmod2),
+                outname,
+                writer=writer,
+            )
+        else:
+            fitmod2.plot_sampler_chains(sampler)
+            writer.savefig(
+                plt.gcf(), [f"{outname}_mcmc_chains.pdf", f"{outname}_mcmc_chains.png"]
+            )
 
-        fitmod2.plot_sampler_corner(flat_samples)
-        plt.savefig(f"{outname}_mcmc_corner.pdf")
-        plt.savefig(f"{outname}_mcmc_corner.png")
-        plt.close()
+            fitmod2.plot_sampler_corner(flat_samples)
+            writer.savefig(
+                plt.gcf(), [f"{outname}_mcmc_corner.pdf", f"{outname}_mcmc_corner.png"]
+            )
 
         fitmod = fitmod2
 
-    # create a stardata object with the best intrinsic (no extinction) model
-    modsed = fitmod.stellar_sed(modinfo)
-    if "BAND" in reddened_star.data.keys():
-        modinfo.band_names = reddened_star.data["BAND"].get_band_names()
-    modsed_stardata = modinfo.SED_to_StarData(modsed)
+    if args.profile_likelihood:
+        os.makedirs("logs", exist_ok=True)
+        memod.profiler.write(f"logs/{args.starname}_lnlike_profile")
 
-    # create an extincion curve and save it
-    extdata = ExtData()
     # get the reddened star data again to have all the possible spectra
     reddened_star_full = StarData(fstarname, path=f"{args.path}", only_bands=only_bands)
-    extdata.calc_elx(reddened_star_full, modsed_stardata, rel_band=rel_band)
-    extdata.columns = dust_columns
-    extdata.save(f"{outname.replace("figs", "exts")}_ext.fits", fit_params=fit_params)
+    save_ext_curve(
+        fitmod,
+        modinfo,
+        reddened_star,
+        reddened_star_full,
+        rel_band,
+        dust_columns,
+        fit_params,
+        f"{outname.replace("figs", "exts")}_ext.fits",
+        writer=writer,
+    )
+
+    # wait for all the outputs to be written and check them
+    if own_writer:
+        failures = writer.close()
+    elif args.cache:
+        # the outputs are stored in the cache so they are needed now
+        failures = {
+            cname: message
+            for cname, message in writer.flush().items()
+            if os.path.basename(cname).startswith(f"{args.starname}_")
+        }
+    else:
+        failures = {}
+    if len(failures) > 0:
+        raise SystemExit(f"{len(failures)} output files failed")
+
+    if args.cache:
+        # only the output files written by this run
+        outfiles = [
+            cname
+            for cname in glob.glob(f"{outname}_*")
+            + glob.glob(f"{outname.replace("figs", "exts")}_*")
+            if os.path.getmtime(cname) >= run_start
+        ]
+        cache.store(fitkey, args.starname, outfiles)
+        cache.log(args.starname, fitkey, "recomputed")
 
     if args.showfit:
         fitmod.plot(reddened_star, modinfo, resid_range=resid_range, lyaplot=lyaplot)
         plt.show()
 
 
+def main():
+    os.environ["OMP_NUM_THREADS"] = "1"
+
+    parser = fit_model_parser()
+    fit_star(parser.parse_args())
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,198 @@
+import copy
+
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+
+
+class GridEmulator(object):
+    """
+    PCA emulator of the model grid spectra
+
+    For each spectrum key, the log10 of the model fluxes is decomposed into
+    a mean spectrum and a small number of principal components.  The
+    coefficients of the components are smooth functions of the grid
+    parameters (logTeff, logg, logZ, vturb) and are interpolated with a thin
+    plate spline surface over the grid.  Only the grid parameters with more
+    than one value are used.
+
+    The accuracy of the emulator between the grid nodes is measured by
+    leaving out interior grid nodes one at a time, rebuilding the surface
+    without each node, and comparing the emulated SED at the node with the
+    grid fluxes (holdout_error).  The principal components are not rebuilt,
+    so this only includes the interpolation and truncation errors.
+
+    Parameters
+    ----------
+    modinfo : ModelData
+        model grid
+    ncomp : int
+        number of principal components for each spectrum key
+    nholdout : int
+        number of interior grid nodes left out to measure the accuracy
+    seed : int
+        random seed for the choice of the left out nodes
+    """
+
+    def __init__(self, modinfo, ncomp=10, nholdout=20, seed=0):
+        self.ncomp = ncomp
+
+        coords = np.column_stack(
+            [modinfo.temps, modinfo.gravs, modinfo.mets, modinfo.vturb]
+        )
+        ptp = np.ptp(coords, axis=0)
+        self.dims = ptp > 0.0
+        self.coord_zero = np.min(coords, axis=0)[self.dims]
+        self.coord_scale = ptp[self.dims]
+        scoords = self._scale(coords)
+
+        self.waves = {}
+        self.mean = {}
+        self.comps = {}
+        self.recon_error = {}
+        allcoeffs = []
+        self.coeff_slices = {}
+        k = 0
+        for cspec in modinfo.fluxes.keys():
+            fluxes = modinfo.fluxes[cspec]
+            logflux = np.log10(np.maximum(fluxes, 1e-10 * np.max(fluxes)))
+            cmean = np.mean(logflux, axis=0)
+            u, s, vt = np.linalg.svd(logflux - cmean, full_matrices=False)
+            cncomp = min(ncomp, len(s))
+            comps = vt[:cncomp]
+            coeffs = (logflux - cmean) @ comps.T
+
+            recon = 10 ** (cmean + coeffs @ comps)
+            gvals = fluxes > 0.0
+            self.recon_error[cspec] = np.max(
+                np.absolute(recon[gvals] / fluxes[gvals] - 1.0)
+            )
+
+            self.waves[cspec] = modinfo.waves[cspec]
+            self.mean[cspec] = cmean
+            self.comps[cspec] = comps
+            self.coeff_slices[cspec] = slice(k, k + cncomp)
+            allcoeffs.append(coeffs)
+            k += cncomp
+
+        # one surface for the coefficients of all the spectrum keys
+        allcoeffs = np.concatenate(allcoeffs, axis=1)
+        self.surface = RBFInterpolator(scoords, allcoeffs, kernel="thin_plate_spline")
+
+        self.holdout_error = self._holdout_error(
+            modinfo, scoords, allcoeffs, nholdout, seed
+        )
+
+        self.grid_size = sum(cfluxes.size for cfluxes in modinfo.fluxes.values())
+        self.size = (
+            scoords.size
+            + allcoeffs.size
+            + sum(
+                cmean.size + self.comps[cspec].size
+                for cspec, cmean in self.mean.items()
+            )
+        )
+
+    @property
+    def npix(self):
+        return {cspec: len(cmean) for cspec, cmean in self.mean.items()}
+
+    def _scale(self, coords):
+        """
+        Grid parameters scaled to the range 0 to 1
+        """
+        return (
+            np.atleast_2d(coords)[:, self.dims] - self.coord_zero
+        ) / self.coord_scale
+
+    def _holdout_error(self, modinfo, scoords, allcoeffs, nholdout, seed):
+        """
+        Leave-one-out error of the emulated SEDs at interior grid nodes
+
+        Returns
+        -------
+        errors : dict
+            maximum fractional error over the pixels for each left out node
+            for each spectrum key
+        """
+        # nodes on the edge of the grid would be extrapolated
+        interior = np.all((scoords > 0.0) & (scoords < 1.0), axis=1)
+        (cands,) = np.where(interior)
+        if len(cands) == 0:
+            (cands,) = np.where(np.full(len(scoords), True))
+        rng = np.random.default_rng(seed)
+        nodes = rng.choice(cands, size=min(nholdout, len(cands)), replace=False)
+
+        errors = {cspec: [] for cspec in self.mean.keys()}
+        for cnode in nodes:
+            csurface = RBFInterpolator(
+                np.delete(scoords, cnode, axis=0),
+                np.delete(allcoeffs, cnode, axis=0),
+                kernel="thin_plate_spline",
+            )
+            coeffs = csurface(scoords[cnode : cnode + 1])[0]
+            for cspec, cmean in self.mean.items():
+                sed = 10 ** (
+                    cmean + coeffs[self.coeff_slices[cspec]] @ self.comps[cspec]
+                )
+                fluxes = modinfo.fluxes[cspec][cnode]
+                gvals = fluxes > 0.0
+                errors[cspec].append(
+                    np.max(np.absolute(sed[gvals] / fluxes[gvals] - 1.0))
+                )
+        return {cspec: np.array(cerrs) for cspec, cerrs in errors.items()}
+
+    def report(self):
+        """
+        Print the accuracy and size of the emulator
+
+        The accuracy is the leave-one-out error between the grid nodes, the
+        reconstruction error at the nodes only includes the PCA truncation.
+        """
+        for cspec, cerr in self.recon_error.items():
+            herr = self.holdout_error[cspec]
+            print(
+                f"{cspec}: {len(self.comps[cspec])} components, "
+                f"leave-one-out error (max, median) = {100.0 * np.max(herr):.3f}%, "
+                f"{100.0 * np.median(herr):.3f}% for {len(herr)} nodes, "
+                f"reconstruction error at the nodes = {100.0 * cerr:.3f}%"
+            )
+        print(
+            f"emulator size: {self.size} values, "
+            f"{100.0 * self.size / self.grid_size:.1f}% of the grid fluxes"
+        )
+
+    def sed(self, logTeff, logg, logZ, vturb):
+        """
+        Emulated stellar SED at the requested grid parameters
+
+        Returns
+        -------
+        sed : dict
+            fluxes for each spectrum key
+        """
+        coeffs = self.surface(self._scale([logTeff, logg, logZ, vturb]))[0]
+        return {
+            cspec: 10 ** (cmean + coeffs[self.coeff_slices[cspec]] @ self.comps[cspec])
+            for cspec, cmean in self.mean.items()
+        }
+
+    def subset(self, indxs):
+        """
+        Copy of the emulator with only some of the pixels of each spectrum
+
+        Parameters
+        ----------
+        indxs : dict
+            pixels to keep for each spectrum key, other keys are dropped
+        """
+        subemu = copy.copy(self)
+        subemu.waves = {
+            cspec: self.waves[cspec][cindxs] for cspec, cindxs in indxs.items()
+        }
+        subemu.mean = {
+            cspec: self.mean[cspec][cindxs] for cspec, cindxs in indxs.items()
+        }
+        subemu.comps = {
+            cspec: self.comps[cspec][:, cindxs] for cspec, cindxs in indxs.items()
+        }
+        return subemu
@@ -0,0 +1,185 @@
+import copy
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+import h5py
+import astropy.units as u
+
+
+def _spectra_attrs(modinfo):
+    """
+    Names of the ModelData attributes that are dictionaries by spectrum key
+    """
+    return [
+        cname
+        for cname, cattr in vars(modinfo).items()
+        if isinstance(cattr, Mapping)
+        and set(cattr.keys()) == set(modinfo.fluxes.keys())
+    ]
+
+
+def _write_values(group, cspec, cvals):
+    """
+    Write one array, keeping the units of quantities
+    """
+    if hasattr(cvals, "unit"):
+        dset = group.create_dataset(cspec, data=cvals.value)
+        dset.attrs["unit"] = cvals.unit.to_string()
+    else:
+        group.create_dataset(cspec, data=np.asarray(cvals))
+
+
+class LazySpectra(Mapping):
+    """
+    Dictionary of arrays by spectrum key read from the grid file when first used
+
+    Parameters
+    ----------
+    filename : str
+        grid file
+    group : str
+        group in the file with one dataset per spectrum key
+    keys : list of str
+        spectrum keys to provide
+    """
+
+    def __init__(self, filename, group, keys):
+        self.filename = filename
+        self.group = group
+        self._keys = list(keys)
+        self._data = {}
+
+    def __getitem__(self, cspec):
+        if cspec not in self._keys:
+            raise KeyError(cspec)
+        if cspec not in self._data:
+            with h5py.File(self.filename, "r") as hfile:
+                dset = hfile[f"{self.group}/{cspec}"]
+                cvals = dset[()]
+                if "unit" in dset.attrs:
+                    cvals = cvals * u.Unit(dset.attrs["unit"])
+            self._data[cspec] = cvals
+        return self._data[cspec]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def save_grid(filename, modinfo, contmodinfo):
+    """
+    Save the line and continuum model grids in one file
+
+    The grid metadata and any arrays that are the same for the two grids
+    (e.g., wavelengths) are only stored once.  Each spectrum key is stored
+    separately so it can be read only when needed.
+
+    Parameters
+    ----------
+    filename : str
+        name of the grid file (hdf5)
+    modinfo : ModelData
+        model grid with lines
+    contmodinfo : ModelData
+        model grid with only the continuum
+    """
+    for cname in ["temps", "gravs", "mets", "vturb"]:
+        if not np.array_equal(getattr(modinfo, cname), getattr(contmodinfo, cname)):
+            raise ValueError(f"line and continuum grids have different {cname}")
+
+    snames = _spectra_attrs(modinfo)
+    skeleton = copy.copy(modinfo)
+    for cname in snames:
+        setattr(skeleton, cname, {})
+
+    with h5py.File(filename, "w") as hfile:
+        hfile.create_dataset("skeleton", data=np.void(pickle.dumps(skeleton)))
+        hfile.attrs["spectra_attrs"] = snames
+        hfile.attrs["spectra_keys"] = list(modinfo.fluxes.keys())
+        for cname in snames:
+            lgroup = hfile.create_group(f"line/{cname}")
+            cgroup = hfile.create_group(f"cont/{cname}")
+            cgroup.attrs["shared"] = True
+            for cspec in modinfo.fluxes.keys():
+                lvals = getattr(modinfo, cname)[cspec]
+                cvals = getattr(contmodinfo, cname)[cspec]
+                _write_values(lgroup, cspec, lvals)
+                if not np.array_equal(np.asarray(lvals), np.asarray(cvals)):
+                    cgroup.attrs["shared"] = False
+            if not cgroup.attrs["shared"]:
+                for cspec in modinfo.fluxes.keys():
+                    _write_values(cgroup, cspec, getattr(contmodinfo, cname)[cspec])
+
+
+def load_grid(filename, keys=None, cont=False, _lazy=None):
+    """
+    Read a model grid from a combined grid file
+
+    The arrays for each spectrum key are only read when they are first used.
+
+    Parameters
+    ----------
+    filename : str
+        name of the grid file (hdf5)
+    keys : list of str
+        spectrum keys to include, default is all, keys not in the file
+        are ignored
+    cont : boolean
+        set to read the continuum model grid
+
+    Returns
+    -------
+    modinfo : ModelData
+        model grid
+    """
+    with h5py.File(filename, "r") as hfile:
+        modinfo = pickle.loads(hfile["skeleton"][()].tobytes())
+        snames = list(hfile.attrs["spectra_attrs"])
+        allkeys = list(hfile.attrs["spectra_keys"])
+        shared = {cname: hfile[f"cont/{cname}"].attrs["shared"] for cname in snames}
+
+    if keys is None:
+        keys = allkeys
+    else:
+        keys = [cspec for cspec in allkeys if cspec in keys]
+
+    if _lazy is None:
+        _lazy = {}
+    for cname in snames:
+        if cont and not shared[cname]:
+            group = f"cont/{cname}"
+        else:
+            group = f"line/{cname}"
+        if group not in _lazy:
+            _lazy[group] = LazySpectra(filename, group, keys)
+        setattr(modinfo, cname, _lazy[group])
+
+    return modinfo
+
+
+def load_line_cont(filename, keys=None):
+    """
+    Read both the line and continuum model grids from a combined grid file
+
+    The arrays that are the same for both grids (e.g., wavelengths) are only
+    read once and shared.
+
+    Parameters
+    ----------
+    filename : str
+        name of the grid file (hdf5)
+    keys : list of str
+        spectrum keys to include, default is all
+
+    Returns
+    -------
+    modinfo, contmodinfo : ModelData
+        model grids with lines and only the continuum
+    """
+    lazy = {}
+    modinfo = load_grid(filename, keys=keys, _lazy=lazy)
+    contmodinfo = load_grid(filename, keys=keys, cont=True, _lazy=lazy)
+    return modinfo, contmodinfo
@@ -0,0 +1,511 @@
+import argparse
+import time
+
+import numpy as np
+import emcee
+
+from measure_extinction.stardata import StarData
+from measure_extinction.model import MEModel
+
+from fit_hessian import get_fit_names
+from fit_model import read_models, setup_model
+from dust_basis import DustBasis
+
+
+class JointLikelihood(object):
+    """
+    Joint likelihood for a sample of stars fit with the same model grid
+
+    The data for all the stars are stacked in padded arrays (one row per star)
+    for each spectrum key.  The stellar SEDs for all the stars are computed
+    in one vectorized pass over the model grid and the chi^2 is reduced over
+    all stars at once.  Missing spectra and padding have zero weight.
+    The dust extinction and HI absorption use each star's model, including
+    any precomputed tables (e.g., FastMEModel.build_lya_table).
+
+    Optional population level priors can be given on any parameter, either
+    fixed Gaussians applied to each star or hierarchical ones where the
+    population mean and log(sigma) are additional fit parameters.  The
+    hierarchical mean has a weak Gaussian prior and sigma a half-normal prior,
+    both bounded, so the posterior is proper.
+
+    Parameters
+    ----------
+    memods : list of MEModel
+        models setup for each star (weights, priors, fixed parameters)
+    obsdata : list of StarData
+        observed data for each star
+    modinfo : ModelData
+        model grid shared by all the stars
+    pop_priors : dict
+        fixed population priors, {"Rv": (mean, sigma), ...}
+    hyper_names : list of str
+        parameters with hierarchical (fit) population mean and sigma
+    hyper_priors : dict
+        priors on the hierarchical mean and sigma, {"Rv": (mean, mean_sigma,
+        sigma_scale, sigma_min), ...}, default is from the parameter bounds
+        (see default_hyper_prior)
+    dust_basis : DustBasis
+        precomputed extinction curve terms, if given the dust extinction
+        for all the stars is computed in one vectorized pass
+    """
+
+    def __init__(
+        self,
+        memods,
+        obsdata,
+        modinfo,
+        pop_priors=None,
+        hyper_names=None,
+        hyper_priors=None,
+        dust_basis=None,
+    ):
+        self.memods = memods
+        self.obsdata = obsdata
+        self.modinfo = modinfo
+        self.nstars = len(memods)
+        self.pop_priors = pop_priors if pop_priors is not None else {}
+        self.hyper_names = hyper_names if hyper_names is not None else []
+        self.hyper_priors = {
+            cname: self.default_hyper_prior(cname) for cname in self.hyper_names
+        }
+        if hyper_priors is not None:
+            self.hyper_priors.update(hyper_priors)
+        self.dust_basis = dust_basis
+
+        for memod in memods:
+            if not memod.windamp.fixed:
+                raise ValueError("wind emission not supported in the joint likelihood")
+
+        # location of each star's fit parameters in the joint vector
+        self.fit_names = [get_fit_names(memod) for memod in memods]
+        nparams = [len(cnames) for cnames in self.fit_names]
+        self.param_slices = []
+        k = 0
+        for cn in nparams:
+            self.param_slices.append(slice(k, k + cn))
+            k += cn
+        self.n_star_params = k
+        self.ndim = k + 2 * len(self.hyper_names)
+
+        # stack the observed data and weights in padded arrays
+        self.spec_names = []
+        self.fluxes = {}
+        self.weights = {}
+        for cspec in modinfo.fluxes.keys():
+            if not any(cspec in cobs.data.keys() for cobs in obsdata):
+                continue
+            self.spec_names.append(cspec)
+            npix = len(modinfo.waves[cspec])
+            self.fluxes[cspec] = np.zeros((self.nstars, npix))
+            self.weights[cspec] = np.zeros((self.nstars, npix))
+            for k, (memod, cobs) in enumerate(zip(memods, obsdata)):
+                if cspec in cobs.data.keys():
+                    nobs = len(cobs.data[cspec].fluxes)
+                    if nobs != npix:
+                        raise ValueError(
+                            f"star {k} has {nobs} {cspec} pixels, "
+                            f"the model grid has {npix}"
+                        )
+                    self.fluxes[cspec][k] = cobs.data[cspec].fluxes.value
+                    self.weights[cspec][k] = memod.weights[cspec]
+
+        # model grid coordinates and the interpolation settings of the grid
+        self.grid_params = np.column_stack(
+            [modinfo.temps, modinfo.gravs, modinfo.mets, modinfo.vturb]
+        )
+        self.grid_width2 = np.array(
+            [
+                modinfo.temps_width2,
+                modinfo.gravs_width2,
+                modinfo.mets_width2,
+                modinfo.vturb_width2,
+            ]
+        )
+        self.n_nearest = modinfo.n_nearest
+
+        # check against the likelihood of each star's model
+        direct = np.array(
+            [memod.lnlike(cobs, modinfo) for memod, cobs in zip(memods, obsdata)]
+        )
+        maxdiff = np.max(np.absolute(self.lnlike_stars() - direct))
+        print(f"joint likelihood: max difference = {maxdiff:.2e} in log(likelihood)")
+
+    def param_range(self, cname):
+        """
+        Range of a parameter from its bounds, None if not bounded
+        """
+        bounds = getattr(self.memods[0], cname).bounds
+        if bounds is None or bounds[0] is None or bounds[1] is None:
+            return None
+        return bounds
+
+    def default_hyper_prior(self, cname):
+        """
+        Weak priors on the population mean and sigma of a parameter
+
+        The mean has a Gaussian prior centered in the bounds with a width of the
+        full range and sigma a half-normal prior with a scale of half the
+        range, with a minimum sigma of 1e-3 of the range.  Without bounds, the
+        scale is set by the current values.
+
+        Returns
+        -------
+        prior : tuple
+            (mean, mean_sigma, sigma_scale, sigma_min)
+        """
+        bounds = self.param_range(cname)
+        if bounds is not None:
+            width = bounds[1] - bounds[0]
+            center = 0.5 * (bounds[0] + bounds[1])
+        else:
+            vals = np.array([getattr(memod, cname).value for memod in self.memods])
+            width = 10.0 * max(np.max(np.absolute(vals)), 1.0)
+            center = np.mean(vals)
+        return (center, width, 0.5 * width, 1e-3 * width)
+
+    def initial_parameters(self):
+        """
+        Joint parameter vector from the current values of the star models
+        """
+        params = np.zeros(self.ndim)
+        for memod, cnames, cslice in zip(
+            self.memods, self.fit_names, self.param_slices
+        ):
+            params[cslice] = [getattr(memod, cname).value for cname in cnames]
+        k = self.n_star_params
+        for cname in self.hyper_names:
+            vals = np.array([getattr(memod, cname).value for memod in self.memods])
+            params[k] = np.mean(vals)
+            params[k + 1] = np.log(
+                max(
+                    np.std(vals),
+                    0.1 * np.absolute(params[k]),
+                    2.0 * self.hyper_priors[cname][3],
+                )
+            )
+            k += 2
+        return params
+
+    def initial_walkers(self, params, nwalkers, scatter=1e-3, rng=None):
+        """
+        Walkers around the joint parameters with additive scatter
+
+        The scatter of each parameter is a fraction of its range (bounds) or
+        of its value and at least the same fraction of 1, so parameters that
+        start at zero (e.g., velocities) also have a spread.
+        """
+        rng = np.random.default_rng(rng)
+        scales = np.zeros(self.ndim)
+        lo = np.full(self.ndim, -np.inf)
+        hi = np.full(self.ndim, np.inf)
+        for memod, cnames, cslice in zip(
+            self.memods, self.fit_names, self.param_slices
+        ):
+            for k, cname in zip(range(cslice.start, cslice.stop), cnames):
+                bounds = getattr(memod, cname).bounds
+                if bounds is not None and bounds[0] is not None:
+                    lo[k] = bounds[0]
+                if bounds is not None and bounds[1] is not None:
+                    hi[k] = bounds[1]
+                if np.isfinite(hi[k] - lo[k]):
+                    scales[k] = hi[k] - lo[k]
+                else:
+                    scales[k] = max(np.absolute(params[k]), 1.0)
+        k = self.n_star_params
+        for cname in self.hyper_names:
+            scales[k] = self.hyper_priors[cname][1]
+            scales[k + 1] = 1.0
+            k += 2
+        p0 = params + scatter * scales * rng.standard_normal((nwalkers, self.ndim))
+        return np.clip(p0, lo, hi)
+
+    def set_parameters(self, params, uncs=None):
+        """
+        Set the star model parameters from the joint parameter vector
+        """
+        for memod, cslice in zip(self.memods, self.param_slices):
+            if uncs is not None:
+                memod.fit_to_parameters(params[cslice], uncs=uncs[cslice])
+            else:
+                memod.fit_to_parameters(params[cslice])
+
+    def lnprior(self, params):
+        """
+        Log(prior) including the individual star and population priors
+        """
+        lnp = 0.0
+        for memod in self.memods:
+            lnp += memod.lnprior()
+        if not np.isfinite(lnp):
+            return -np.inf
+
+        for cname, (cmean, csig) in self.pop_priors.items():
+            vals = np.array([getattr(memod, cname).value for memod in self.memods])
+            lnp += -0.5 * np.sum(np.square((vals - cmean) / csig))
+
+        k = self.n_star_params
+        for cname in self.hyper_names:
+            cmean = params[k]
+            csig = np.exp(params[k + 1])
+            pmean, pmean_sig, psig_scale, psig_min = self.hyper_priors[cname]
+            bounds = self.param_range(cname)
+            if bounds is not None and not (bounds[0] <= cmean <= bounds[1]):
+                return -np.inf
+            if csig < psig_min:
+                return -np.inf
+            # weak Gaussian on the mean, half-normal on sigma with the
+            # Jacobian for sampling in log(sigma)
+            lnp += -0.5 * np.square((cmean - pmean) / pmean_sig)
+            lnp += -0.5 * np.square(csig / psig_scale) + np.log(csig)
+            vals = np.array([getattr(memod, cname).value for memod in self.memods])
+            lnp += np.sum(-0.5 * np.square((vals - cmean) / csig) - np.log(csig))
+            k += 2
+
+        return lnp
+
+    def stellar_seds(self):
+        """
+        Stellar SEDs for all the stars in one pass over the model grid
+
+        Uses the same inverse distance weighting of the nearest grid models
+        as MEModel.stellar_sed, with the widths and number of nearest models
+        of the grid.
+
+        Returns
+        -------
+        seds : dict
+            SEDs with shape (nstars, npix) for each spectrum key
+        """
+        pvals = np.array(
+            [
+                [
+                    memod.logTeff.value,
+                    memod.logg.value,
+                    memod.logZ.value,
+                    memod.vturb.value,
+                ]
+                for memod in self.memods
+            ]
+        )
+        dist2 = np.sum(
+            np.square(pvals[:, None, :] - self.grid_params[None, :, :])
+            / self.grid_width2,
+            axis=2,
+        )
+        nindxs = np.argsort(dist2, axis=1)[:, : self.n_nearest]
+        ndist2 = np.maximum(np.take_along_axis(dist2, nindxs, axis=1), 1e-20)
+        gweights = 1.0 / np.sqrt(ndist2)
+        gweights /= np.sum(gweights, axis=1)[:, None]
+
+        velocities = np.array([memod.velocity.value for memod in self.memods])
+        seds = {}
+        for cspec in self.modinfo.fluxes.keys():
+            seds[cspec] = np.einsum(
+                "sn,snp->sp", gweights, self.modinfo.fluxes[cspec][nindxs, :]
+            )
+            if cspec != "BAND":
+                cwaves = self.modinfo.waves[cspec].value
+                for k, cvel in enumerate(velocities):
+                    seds[cspec][k] = np.interp(
+                        cwaves, (1.0 + cvel / 2.998e5) * cwaves, seds[cspec][k]
+                    )
+        return seds
+
+    def model_seds(self):
+        """
+        Full forward model (stellar, dust extinction, HI absorption) for all
+        the stars, without the normalization
+        """
+        seds = self.stellar_seds()
+        if self.dust_basis is not None:
+            pvals = {
+                cname: np.array([getattr(memod, cname).value for memod in self.memods])
+                for cname in ["Av", "Rv", "C2", "B3", "C4", "xo", "gamma", "velocity"]
+            }
+            axav = self.dust_basis.axav(
+                pvals["Rv"],
+                pvals["C2"],
+                pvals["B3"],
+                pvals["C4"],
+                pvals["xo"],
+                pvals["gamma"],
+                pvals["velocity"],
+            )
+            for cspec in seds.keys():
+                seds[cspec] *= 10 ** (-0.4 * axav[cspec] * pvals["Av"][:, None])
+
+        for k, memod in enumerate(self.memods):
+            csed = {cspec: seds[cspec][k] for cspec in seds.keys()}
+            if self.dust_basis is None:
+                csed = memod.dust_extinguished_sed(self.modinfo, csed)
+            hi_sed = memod.hi_abs_sed(self.modinfo, csed)
+            for cspec in seds.keys():
+                seds[cspec][k] = hi_sed[cspec]
+        return seds
+
+    def lnlike_stars(self):
+        """
+        Log(likelihood) for each star
+
+        Returns
+        -------
+        lnl : ndarray
+            log(likelihood) values with shape (nstars)
+        """
+        seds = self.model_seds()
+        norms = np.array([memod.norm.value for memod in self.memods])
+        lnl = np.zeros(self.nstars)
+        for cspec in self.spec_names:
+            modspec = seds[cspec] * norms[:, None]
+            gvals = (self.weights[cspec] > 0) & np.isfinite(modspec)
+            chiarr = np.square((self.fluxes[cspec] - modspec) * self.weights[cspec])
+            lnl += -0.5 * np.sum(chiarr, axis=1, where=gvals)
+        return lnl
+
+    def lnprob(self, params):
+        """
+        Joint log(posterior) for all the stars
+        """
+        self.set_parameters(params)
+        lnp = self.lnprior(params)
+        if not np.isfinite(lnp):
+            return -np.inf
+        return lnp + np.sum(self.lnlike_stars())
+
+    def __call__(self, params):
+        return self.lnprob(params)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("starnames", help="names of stars", nargs="+")
+    parser.add_argument("--path", help="Path to star data", default="./data/faintwds/")
+    parser.add_argument(
+        "--modtype",
+        help="Pick the type of model grid",
+        choices=["obstars", "whitedwarfs"],
+        default="whitedwarfs",
+    )
+    parser.add_argument(
+        "--modpath",
+        help="path to the model files",
+        default="/home/kgordon/Python/extstar_data/Models/",
+    )
+    parser.add_argument(
+        "--picmodel",
+        help="Set to read model grid from pickle file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--Av_init", help="initial A(V) for fitting", default=0.2, type=float
+    )
+    parser.add_argument(
+        "--lyatable",
+        help="use a precomputed Ly-alpha absorption table for the MW HI",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dustbasis",
+        help="use precomputed extinction curve terms",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hyper",
+        help="parameters with hierarchical population priors (e.g., Rv C2 B3)",
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--pop_prior",
+        help="fixed population prior on a parameter, e.g., --pop_prior Rv 3.1 0.3",
+        nargs=3,
+        metavar=("NAME", "MEAN", "SIGMA"),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--ncalls", help="number of likelihood calls for timing", default=20, type=int
+    )
+    parser.add_argument("--mcmc", help="run EMCEE MCMC fitting", action="store_true")
+    parser.add_argument(
+        "--mcmc_nsteps", help="number of MCMC steps", default=1000, type=int
+    )
+    args = parser.parse_args()
+
+    modinfo = read_models(args.modtype, args.modpath, args.picmodel)
+
+    obsdata = []
+    memods = []
+    for cname in args.starnames:
+        reddened_star = StarData(f"{cname}.dat", path=f"{args.path}")
+        obsdata.append(reddened_star)
+        memod = setup_model(reddened_star, modinfo, args.modtype, args.Av_init, False)
+        if args.lyatable:
+            memod.build_lya_table(modinfo)
+        memods.append(memod)
+
+    if args.dustbasis:
+        dust_basis = DustBasis(modinfo)
+        for memod in memods:
+            memod.build_dust_basis(modinfo, dust_basis=dust_basis)
+    else:
+        dust_basis = None
+
+    pop_priors = {
+        cname: (float(cmean), float(csig)) for cname, cmean, csig in args.pop_prior
+    }
+    joint = JointLikelihood(
+        memods,
+        obsdata,
+        modinfo,
+        pop_priors=pop_priors,
+        hyper_names=args.hyper,
+        dust_basis=dust_basis,
+    )
+    params = joint.initial_parameters()
+
+    # compare the throughput with the individual star likelihoods
+    start_time = time.time()
+    for i in range(args.ncalls):
+        for memod, cobs, cslice in zip(memods, obsdata, joint.param_slices):
+            MEModel.lnprob(params[cslice], memod, cobs, modinfo)
+    single_time = (time.time() - start_time) / args.ncalls
+    start_time = time.time()
+    for i in range(args.ncalls):
+        joint.lnprob(params)
+    joint_time = (time.time() - start_time) / args.ncalls
+    print(f"{joint.nstars} stars, {joint.ndim} parameters")
+    print(f"individual likelihoods: {single_time:.4f} s per step")
+    print(f"joint likelihood: {joint_time:.4f} s per step")
+
+    if args.mcmc:
+        print("starting sampling")
+        start_time = time.time()
+
+        nwalkers = 2 * joint.ndim
+        p0 = joint.initial_walkers(params, nwalkers)
+        backend = emcee.backends.HDFBackend("exts/joint_.h5")
+        backend.reset(nwalkers, joint.ndim)
+        sampler = emcee.EnsembleSampler(nwalkers, joint.ndim, joint, backend=backend)
+        sampler.run_mcmc(p0, args.mcmc_nsteps, progress=True)
+
+        print("finished sampling")
+        print("--- %s seconds ---" % (time.time() - start_time))
+
+        flat_samples = sampler.get_chain(discard=int(0.5 * args.mcmc_nsteps), flat=True)
+        per = np.percentile(flat_samples, [16, 50, 84], axis=0)
+        joint.set_parameters(per[1], uncs=0.5 * (per[2] - per[0]))
+        for cname, memod in zip(args.starnames, memods):
+            print(f"{cname} p50 parameters")
+            memod.pprint_parameters()
+        k = joint.n_star_params
+        for cname in joint.hyper_names:
+            print(
+                f"population {cname}: mean = {per[1][k]:.3f}, sigma = {np.exp(per[1][k + 1]):.3f}"
+            )
+            k += 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# parts of the likelihood calculation that are timed
+components = ["stellar_sed", "dust_extinguished_sed", "hi_abs_sed", "norm", "chi2"]
+
+
+class LikelihoodProfiler(object):
+    """
+    Timing of the parts of the likelihood for a random sample of calls
+
+    Only the sampled calls are timed so the overhead is small.  Copies of the
+    profiler are the profiler itself, so the timings from the copies of the
+    model made during fitting are all collected.
+
+    Parameters
+    ----------
+    fraction : float
+        fraction of the likelihood calls to time
+    seed : int
+        random seed for the sampling
+    """
+
+    def __init__(self, fraction=0.01, seed=None):
+        self.fraction = fraction
+        self.rng = np.random.default_rng(seed)
+        self.ncalls = 0
+        self.nsampled = 0
+        self.times = {cname: 0.0 for cname in ["lnlike"] + components}
+        self.counts = {cname: 0 for cname in ["lnlike"] + components}
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def sample(self):
+        """
+        Count a likelihood call and decide if it is timed
+        """
+        self.ncalls += 1
+        if self.rng.random() < self.fraction:
+            self.nsampled += 1
+            return True
+        return False
+
+    @contextmanager
+    def timer(self, cname):
+        """
+        Add the time spent in the with block to a component
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[cname] += time.perf_counter() - start
+            self.counts[cname] += 1
+
+    def wrap(self, cname, func):
+        """
+        Function that times each call of func as a component
+        """
+
+        def timed(*args, **kwargs):
+            with self.timer(cname):
+                return func(*args, **kwargs)
+
+        return timed
+
+    def remainder(self):
+        """
+        Time in lnlike not in any of the timed components
+        """
+        return max(
+            self.times["lnlike"] - sum(self.times[cname] for cname in components),
+            0.0,
+        )
+
+    def summary(self):
+        """
+        Table of the timings
+
+        Returns
+        -------
+        lines : list of str
+            lines of the table
+        """
+        lines = [
+            f"likelihood calls: {self.ncalls}, timed: {self.nsampled} "
+            f"(fraction = {self.fraction})",
+            f"{'component':>22s} {'calls':>8s} {'total [s]':>11s} "
+            f"{'per call [ms]':>14s} {'of lnlike':>10s}",
+        ]
+        ltime = max(self.times["lnlike"], 1e-30)
+        for cname in ["lnlike"] + components + ["other"]:
+            if cname == "other":
+                ctime = self.remainder()
+                ccount = self.counts["lnlike"]
+            else:
+                ctime = self.times[cname]
+                ccount = self.counts[cname]
+            lines.append(
+                f"{cname:>22s} {ccount:8d} {ctime:11.4f} "
+                f"{1e3 * ctime / max(ccount, 1):14.4f} {100.0 * ctime / ltime:9.1f}%"
+            )
+        if self.nsampled > 0:
+            lines.append(
+                "estimated total lnlike time for all calls: "
+                f"{ltime * self.ncalls / self.nsampled:.2f} s"
+            )
+        return lines
+
+    def folded_stacks(self):
+        """
+        Timings as folded stacks (e.g., for flamegraph.pl or speedscope)
+
+        Returns
+        -------
+        lines : list of str
+            one "lnlike;component microseconds" line per component
+        """
+        lines = [f"lnlike {int(1e6 * self.remainder())}"]
+        for cname in components:
+            if self.counts[cname] > 0:
+                lines.append(f"lnlike;{cname} {int(1e6 * self.times[cname])}")
+        return lines
+
+    def write(self, basename):
+        """
+        Print the summary and write it and the folded stacks to files
+
+        Parameters
+        ----------
+        basename : str
+            output files are basename.txt and basename.folded
+        """
+        lines = self.summary()
+        print("\n".join(lines))
+        with open(f"{basename}.txt", "w") as ofile:
+            ofile.write("\n".join(lines) + "\n")
+        with open(f"{basename}.folded", "w") as ofile:
+            ofile.write("\n".join(self.folded_stacks()) + "\n")
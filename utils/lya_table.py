@@ -0,0 +1,140 @@
+import copy
+
+import numpy as np
+
+from measure_extinction.model import MEModel
+
+
+class LyaTable(object):
+    """
+    Tabulated Lyman-alpha absorption for the Milky Way HI component
+
+    The absorption is exp(-N(HI) phi(lambda; v)) where phi is the damped
+    Lyman-alpha cross section at the velocity v (vel_MW).  As the optical
+    depth is linear in N(HI), only phi is tabulated on a regular velocity
+    grid for the star's data wavelengths and the column density is applied
+    exactly.  phi is measured from MEModel.hi_abs_sed itself, by comparing
+    the absorption of a unit SED with and without the Milky Way column.
+
+    Linear interpolation in velocity is the only approximation.  The largest
+    error in the transmission is at the midpoints of the velocity grid.  When
+    the table is built, the transmission at these midpoints for a grid of
+    columns over the logHI_MW bounds is compared with MEModel.hi_abs_sed,
+    divided by the transmission without the Milky Way column so any other HI
+    components are removed, and the worst difference is stored in max_error.
+
+    Parameters
+    ----------
+    memod : MEModel
+        model for the star, only the HI parameters are used
+    modinfo : ModelData
+        model grid giving the data wavelengths
+    vel_range : 2 element tuple
+        range of vel_MW covered, default is the vel_MW bounds
+    dvel : float
+        velocity spacing of the table [km/s]
+    nlogHI : int
+        number of columns over the logHI_MW bounds used for max_error
+    """
+
+    # reference log(N(HI)) values used to measure phi, the largest one that
+    # is not saturated is used for each pixel
+    ref_logHI = [8.0, 12.0, 16.0, 20.0]
+
+    def __init__(self, memod, modinfo, vel_range=None, dvel=2.0, nlogHI=9):
+        probe = copy.deepcopy(memod)
+        if vel_range is None:
+            vel_range = probe.vel_MW.bounds
+        self.vels = np.arange(vel_range[0], vel_range[1] + 0.5 * dvel, dvel)
+        self.dvel = dvel
+
+        unit_sed = {
+            cspec: np.full(len(modinfo.waves[cspec]), 1.0)
+            for cspec in modinfo.fluxes.keys()
+        }
+
+        phis = {cspec: [] for cspec in unit_sed.keys()}
+        for cvel in self.vels:
+            cphi = self._direct_phi(probe, modinfo, unit_sed, cvel)
+            for cspec in unit_sed.keys():
+                phis[cspec].append(cphi[cspec])
+
+        # only keep the pixels with absorption
+        self.npix = {cspec: len(cvals) for cspec, cvals in unit_sed.items()}
+        self.waves = {cspec: modinfo.waves[cspec] for cspec in unit_sed.keys()}
+        self.indxs = {}
+        self.phi = {}
+        for cspec in unit_sed.keys():
+            cphi = np.array(phis[cspec])
+            (gindxs,) = np.where(np.any(cphi > 0.0, axis=0))
+            if len(gindxs) > 0:
+                self.indxs[cspec] = gindxs
+                self.phi[cspec] = cphi[:, gindxs]
+
+        # accuracy at the midpoints of the velocity grid over the columns
+        self.max_error = 0.0
+        logHIs = np.linspace(probe.logHI_MW.bounds[0], probe.logHI_MW.bounds[1], nlogHI)
+        for cvel in 0.5 * (self.vels[1:] + self.vels[:-1]):
+            probe.vel_MW.value = cvel
+            probe.logHI_MW.value = 0.0
+            trans0 = MEModel.hi_abs_sed(probe, modinfo, unit_sed)
+            for clogHI in logHIs:
+                probe.logHI_MW.value = clogHI
+                dtrans = MEModel.hi_abs_sed(probe, modinfo, unit_sed)
+                ttrans = self.transmission(clogHI, cvel)
+                for cspec in unit_sed.keys():
+                    ctrans = np.full(self.npix[cspec], 1.0)
+                    if cspec in ttrans.keys():
+                        ctrans[self.indxs[cspec]] = ttrans[cspec]
+                    # pixels saturated by the other components are skipped
+                    gvals = trans0[cspec] > 1e-200
+                    cerr = np.absolute(
+                        ctrans[gvals] - dtrans[cspec][gvals] / trans0[cspec][gvals]
+                    )
+                    self.max_error = max(self.max_error, np.max(cerr, initial=0.0))
+
+    def _direct_phi(self, probe, modinfo, unit_sed, vel):
+        """
+        Cross section measured from MEModel.hi_abs_sed at one velocity
+        """
+        probe.vel_MW.value = vel
+        probe.logHI_MW.value = 0.0
+        trans0 = MEModel.hi_abs_sed(probe, modinfo, unit_sed)
+        phi = {cspec: np.zeros(len(cvals)) for cspec, cvals in unit_sed.items()}
+        for clogHI in self.ref_logHI:
+            probe.logHI_MW.value = clogHI
+            trans = MEModel.hi_abs_sed(probe, modinfo, unit_sed)
+            for cspec in unit_sed.keys():
+                # saturated pixels (zero transmission) are skipped
+                gvals = (trans[cspec] > 1e-200) & (trans0[cspec] > 1e-200)
+                cphi = (np.log(trans0[cspec][gvals]) - np.log(trans[cspec][gvals])) / (
+                    10**clogHI - 1.0
+                )
+                phi[cspec][gvals] = cphi
+        return phi
+
+    def interp_phi(self, vel):
+        """
+        Cross section at vel interpolated from the table
+
+        Returns
+        -------
+        phi : dict
+            cross section for the absorbed pixels of each spectrum key
+        """
+        fpos = np.clip((vel - self.vels[0]) / self.dvel, 0.0, len(self.vels) - 1.0)
+        k = min(int(fpos), len(self.vels) - 2)
+        w = fpos - k
+        return {
+            cspec: (1.0 - w) * cphi[k] + w * cphi[k + 1]
+            for cspec, cphi in self.phi.items()
+        }
+
+    def transmission(self, logHI, vel):
+        """
+        Transmission for the absorbed pixels of each spectrum key
+        """
+        nhi = 10**logHI
+        return {
+            cspec: np.exp(-nhi * cphi) for cspec, cphi in self.interp_phi(vel).items()
+        }
@@ -0,0 +1,203 @@
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import matplotlib.pyplot as plt
+
+# first bytes of the files for the formats that are checked
+magic_bytes = {
+    ".pdf": b"%PDF",
+    ".png": b"\x89PNG",
+    ".fits": b"SIMPLE",
+    ".h5": b"\x89HDF",
+}
+
+
+def _save_figure(payload, filenames):
+    """
+    Save a pickled figure to each of the files
+    """
+    fig = pickle.loads(payload)
+    for cname in filenames:
+        fig.savefig(cname)
+    plt.close(fig)
+
+
+def _save_object(payload, filename, kwargs):
+    """
+    Call the save method of a pickled object (e.g., ExtData)
+    """
+    pickle.loads(payload).save(filename, **kwargs)
+
+
+def verify_file(filename, since=0.0):
+    """
+    Check that a file was written and looks complete
+
+    Parameters
+    ----------
+    filename : str
+        file to check
+    since : float
+        the file must have been modified after this time [s since the epoch]
+
+    Returns
+    -------
+    message : str
+        problem with the file, None if the file is good
+    """
+    if not os.path.isfile(filename):
+        return "not written"
+    fstat = os.stat(filename)
+    if fstat.st_size == 0:
+        return "empty"
+    if fstat.st_mtime < since:
+        return "not updated"
+    cmagic = magic_bytes.get(os.path.splitext(filename)[1])
+    if cmagic is not None:
+        with open(filename, "rb") as cfile:
+            if cfile.read(len(cmagic)) != cmagic:
+                return "unexpected file format"
+    return None
+
+
+class OutputWriter(object):
+    """
+    Write the output figures and files in a background process
+
+    The figures and objects are pickled when submitted so the fitting can
+    continue while they are rendered and written.  At most maxqueue outputs
+    are pending, submitting more waits for the oldest to finish.  Anything
+    that cannot be pickled is written directly.  flush waits for all the
+    outputs and checks the files, the failed files of all the flushes are
+    kept in failures (e.g., for a writer used for several stars).
+
+    Parameters
+    ----------
+    background : boolean
+        set to write in a background process, otherwise outputs are written
+        when submitted
+    maxqueue : int
+        maximum number of pending outputs
+    """
+
+    def __init__(self, background=True, maxqueue=4):
+        self.maxqueue = maxqueue
+        self.executor = ProcessPoolExecutor(max_workers=1) if background else None
+        self.pending = {}
+        self.done = []
+        self.failures = {}
+
+    def _write_now(self, func, args, filenames):
+        """
+        Run func(*args) writing filenames
+        """
+        start = time.time()
+        error = None
+        try:
+            func(*args)
+        except Exception as err:
+            error = err
+        self.done.append((filenames, start, error))
+
+    def _submit(self, func, args, filenames):
+        """
+        Run func(*args) in the background writing filenames
+        """
+        if self.executor is None:
+            self._write_now(func, args, filenames)
+            return
+        start = time.time()
+        while len(self.pending) >= self.maxqueue:
+            self._collect(return_when="FIRST_COMPLETED")
+        future = self.executor.submit(func, *args)
+        self.pending[future] = (filenames, start)
+
+    def _collect(self, return_when):
+        finished, _ = wait(list(self.pending.keys()), return_when=return_when)
+        for future in finished:
+            filenames, start = self.pending.pop(future)
+            self.done.append((filenames, start, future.exception()))
+
+    def savefig(self, fig, filenames):
+        """
+        Save a figure to each of the files and close it
+
+        Parameters
+        ----------
+        fig : matplotlib.figure.Figure
+            figure
+        filenames : list of str
+            files to write, the format is set by the extension
+        """
+        plt.close(fig)
+        try:
+            if self.executor is None:
+                raise RuntimeError("no background process")
+            payload = pickle.dumps(fig)
+        except Exception:
+            self._write_now(
+                lambda: [fig.savefig(cname) for cname in filenames], (), filenames
+            )
+            return
+        self._submit(_save_figure, (payload, filenames), filenames)
+
+    def save(self, obj, filename, **kwargs):
+        """
+        Call obj.save(filename, **kwargs), e.g., for ExtData
+
+        Parameters
+        ----------
+        obj : object
+            object with a save method
+        filename : str
+            file to write
+        kwargs : dict
+            passed to the save method
+        """
+        try:
+            if self.executor is None:
+                raise RuntimeError("no background process")
+            payload = pickle.dumps(obj)
+        except Exception:
+            self._write_now(lambda: obj.save(filename, **kwargs), (), [filename])
+            return
+        self._submit(_save_object, (payload, filename, kwargs), [filename])
+
+    def flush(self):
+        """
+        Wait for all the outputs and check the files
+
+        Returns
+        -------
+        failures : dict
+            problem for each file that failed
+        """
+        if len(self.pending) > 0:
+            self._collect(return_when="ALL_COMPLETED")
+        failures = {}
+        for filenames, start, error in self.done:
+            for cname in filenames:
+                if error is not None:
+                    failures[cname] = f"error: {error!r}"
+                else:
+                    message = verify_file(cname, since=start - 1.0)
+                    if message is not None:
+                        failures[cname] = message
+        nfiles = sum(len(filenames) for filenames, start, error in self.done)
+        print(f"output: {nfiles - len(failures)} of {nfiles} files written")
+        for cname, message in failures.items():
+            print(f"output failed: {cname} ({message})")
+        self.done = []
+        self.failures.update(failures)
+        return failures
+
+    def close(self):
+        """
+        Flush the outputs and stop the background process
+        """
+        failures = self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+        return failures
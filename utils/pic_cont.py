@@ -1,11 +1,26 @@
+import argparse
 import glob
 import pickle
 import time
 
 from measure_extinction.modeldata import ModelData
 
+from grid_emulator import GridEmulator
+from grid_file import save_grid
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--emulator",
+        help="also build and pickle a PCA emulator of each grid",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ncomp", help="number of PCA components for the emulator", default=10, type=int
+    )
+    args = parser.parse_args()
+
     # model data
     start_time = time.time()
     print("reading model files")
@@ -31,6 +46,7 @@ if __name__ == "__main__":
         "WFC3_G141",
     ]
 
+    modinfos = {}
     for mtype in ["", "cont"]:
 
         if mtype == "cont":
@@ -54,5 +70,16 @@ if __name__ == "__main__":
             spectra_names=data_names,
         )
         pickle.dump(modinfo, open(f"{modstr}{mtype}modinfo.p", "wb"))
+        modinfos[mtype] = modinfo
         print("finished reading model files")
-        print("--- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+        print("--- %s seconds ---" % (time.time() - start_time))
+
+        if args.emulator:
+            print("building emulator")
+            emulator = GridEmulator(modinfo, ncomp=args.ncomp)
+            emulator.report()
+            pickle.dump(emulator, open(f"{modstr}{mtype}emulator.p", "wb"))
+
+    # combined line and continuum grid file with lazy loading of each spectrum
+    save_grid(f"{modstr}grid.h5", modinfos[""], modinfos["cont"])
+    print(f"combined grid saved in {modstr}grid.h5")
@@ -0,0 +1,191 @@
+import argparse
+import glob
+import os
+import time
+from multiprocessing import Pool
+
+import astropy.units as u
+
+from measure_extinction.stardata import StarData
+from measure_extinction.extdata import ExtData
+from measure_extinction.model import MEModel
+
+from fit_model import read_models, save_ext_curve
+from grid_file import load_grid
+
+# model grid for each worker process, read once by the main process
+_worker_modinfo = None
+
+
+def _init_worker(modinfo):
+    global _worker_modinfo
+    _worker_modinfo = modinfo
+
+
+def regen_curve(extfile, path, rel_band, fittype=None, outpath=None):
+    """
+    Recompute the extinction curve of a star from its saved fit parameters
+
+    Parameters
+    ----------
+    extfile : str
+        extinction curve file written by fit_model.py
+    path : str
+        path to the star data, only used if the path is not saved with the fit
+    rel_band : str or astropy.Quantity
+        band or wavelength the curve is relative to, 0.55 micron is used if the
+        star does not have band data
+    fittype : str
+        fit parameters to use for the curve (e.g., MIN, MCMC), default is MCMC
+        if present, otherwise MIN, the saved A(V) and R(V) columns are always
+        from the final (last) fit type as for fit_model.py
+    outpath : str
+        path for the new curve file, default is to replace extfile
+
+    Returns
+    -------
+    message : str
+        result for this star
+    """
+    starname = os.path.basename(extfile).replace("_mefit_ext.fits", "")
+    start_time = time.time()
+    modinfo = _worker_modinfo
+
+    fit_params = ExtData(filename=extfile).fit_params
+    if fittype is None:
+        fittype = "MCMC" if "MCMC" in fit_params.keys() else "MIN"
+    ptab = fit_params[fittype]
+    path = ptab.meta.get("DATAPATH", path)
+
+    reddened_star = StarData(f"{starname}.dat", path=path)
+    if "BAND" not in reddened_star.data.keys():
+        rel_band = 0.55 * u.micron
+
+    memod = MEModel(modinfo=modinfo, obsdata=reddened_star)
+    for cname, cval in zip(ptab["name"], ptab["value"]):
+        getattr(memod, cname).value = cval
+
+    # results_catalog.py reads the columns as those of the final fit type
+    ctab = fit_params[list(fit_params.keys())[-1]]
+    vals = dict(zip(ctab["name"], ctab["value"]))
+    uncs = dict(zip(ctab["name"], ctab["unc"]))
+    dust_columns = {
+        "AV": (vals["Av"], uncs["Av"]),
+        "RV": (vals["Rv"], uncs["Rv"]),
+    }
+
+    if outpath is not None:
+        extfile = os.path.join(outpath, os.path.basename(extfile))
+    save_ext_curve(
+        memod,
+        modinfo,
+        reddened_star,
+        reddened_star,
+        rel_band,
+        dust_columns,
+        fit_params,
+        extfile,
+    )
+    return f"{starname}: {fittype} curve saved, {time.time() - start_time:.1f} seconds"
+
+
+def _regen_curve_kwargs(args):
+    extfile, kwargs = args
+    try:
+        return regen_curve(extfile, **kwargs)
+    except Exception as err:
+        return f"{os.path.basename(extfile)}: failed, {err!r}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "starnames", nargs="*", help="names of stars, default is all fitted stars"
+    )
+    parser.add_argument(
+        "--path",
+        help="path to star data, if not saved with the fit",
+        default="./data/faintwds/",
+    )
+    parser.add_argument(
+        "--extpath", help="path to the extinction curve files", default="./exts/"
+    )
+    parser.add_argument(
+        "--outpath", help="path for the new curves, default is --extpath", default=None
+    )
+    parser.add_argument(
+        "--rel_band",
+        help="band or wavelength [micron] the curves are relative to",
+        default="WFC3_F475W",
+    )
+    parser.add_argument(
+        "--fittype",
+        help="fit parameters for the curve, default is MCMC if present, otherwise "
+        "MIN, the A(V) and R(V) columns are always from the final fit",
+        choices=["MIN", "HESS", "MCMC"],
+        default=None,
+    )
+    parser.add_argument(
+        "--modtype",
+        help="Pick the type of model grid",
+        choices=["obstars", "whitedwarfs"],
+        default="whitedwarfs",
+    )
+    parser.add_argument(
+        "--modpath",
+        help="path to the model files",
+        default="/home/kgordon/Python/extstar_data/Models/",
+    )
+    parser.add_argument(
+        "--picmodel",
+        help="Set to read model grid from pickle file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--gridfile",
+        help="combined grid file (from pic_cont.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--nproc", help="number of stars done in parallel", default=4, type=int
+    )
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if len(args.starnames) > 0:
+        extfiles = [
+            os.path.join(args.extpath, f"{cname}_mefit_ext.fits")
+            for cname in args.starnames
+        ]
+    else:
+        extfiles = sorted(glob.glob(os.path.join(args.extpath, "*_mefit_ext.fits")))
+
+    try:
+        rel_band = float(args.rel_band) * u.micron
+    except ValueError:
+        rel_band = args.rel_band
+
+    kwargs = {
+        "path": args.path,
+        "rel_band": rel_band,
+        "fittype": args.fittype,
+        "outpath": args.outpath,
+    }
+    # the grid is read once and passed to the workers, the grid file spectra
+    # are only read by the workers when used
+    if args.gridfile is not None:
+        modinfo = load_grid(args.gridfile)
+    else:
+        modinfo = read_models(args.modtype, args.modpath, args.picmodel)
+
+    with Pool(args.nproc, initializer=_init_worker, initargs=(modinfo,)) as pool:
+        for message in pool.imap_unordered(
+            _regen_curve_kwargs, [(cfile, kwargs) for cfile in extfiles]
+        ):
+            print(message)
+    print(f"{len(extfiles)} curves")
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import h5py
+from astropy.table import Table
+
+from measure_extinction.extdata import ExtData
+
+# columns of the catalog that are not fit parameters
+info_names = ["star", "fittype", "file", "mtime", "size"]
+# run information saved by fit_model.py in the fit parameter table headers
+run_names = ["RUNTIME", "DATAPATH", "MODTYPE", "MOVES", "NTEMPS", "MINESS", "CPUHOUR"]
+# fit parameters giving the extinction columns
+column_params = {"AV": "Av", "RV": "Rv"}
+
+
+def _param_rows(ptab):
+    """
+    Fit parameter table as a dictionary of columns by parameter name
+
+    Parameters
+    ----------
+    ptab : astropy Table
+        fit parameters as saved by MEModel.save_parameters
+
+    Returns
+    -------
+    pvals : dict
+        catalog columns, e.g., {"Av": value, "Av_unc": unc, "Av_fixed": fixed}
+    """
+    pvals = {}
+    if "name" in ptab.colnames:
+        # one row per parameter
+        for crow in ptab:
+            cname = str(crow["name"])
+            for ccol in ptab.colnames:
+                if ccol == "name" or ptab[ccol].dtype.kind not in "biuf":
+                    continue
+                if ccol == "value":
+                    pvals[cname] = crow[ccol]
+                else:
+                    pvals[f"{cname}_{ccol}"] = crow[ccol]
+    else:
+        # one column per parameter
+        for ccol in ptab.colnames:
+            if ptab[ccol].dtype.kind in "biuf":
+                pvals[ccol] = ptab[ccol][0]
+    return pvals
+
+
+def read_extfile(filename):
+    """
+    Catalog rows for all the fit types in one extinction file
+
+    Parameters
+    ----------
+    filename : str
+        extinction file written by fit_model.py
+
+    Returns
+    -------
+    rows : list of dict
+        one catalog row for each fit type (e.g., MIN, HESS, MCMC)
+    """
+    star = os.path.basename(filename).replace("_mefit_ext.fits", "")
+    fstat = os.stat(filename)
+    ext = ExtData(filename)
+
+    fittypes = list(ext.fit_params.keys())
+    rows = []
+    for fittype, ptab in ext.fit_params.items():
+        crow = {
+            "star": star,
+            "fittype": fittype,
+            "file": filename,
+            "mtime": fstat.st_mtime,
+            "size": fstat.st_size,
+        }
+        # run information saved by fit_model.py
+        for cname in run_names:
+            if cname in ptab.meta.keys():
+                crow[cname.lower()] = ptab.meta[cname]
+        pvals = _param_rows(ptab)
+        crow.update(pvals)
+        # columns (e.g., AV, RV) are saved for the final (last) fit type,
+        # the other fit types get A(V) and R(V) from their own parameters
+        for cname, cval in ext.columns.items():
+            if fittype == fittypes[-1]:
+                if isinstance(cval, tuple):
+                    crow[f"col_{cname}"] = cval[0]
+                    crow[f"col_{cname}_unc"] = cval[1]
+                else:
+                    crow[f"col_{cname}"] = cval
+            elif column_params.get(cname) in pvals.keys():
+                pname = column_params[cname]
+                crow[f"col_{cname}"] = pvals[pname]
+                if f"{pname}_unc" in pvals.keys():
+                    crow[f"col_{cname}_unc"] = pvals[f"{pname}_unc"]
+        rows.append(crow)
+
+    return rows
+
+
+def column_array(rows, cname):
+    """
+    Array of one catalog column, missing values are NaN or ""
+    """
+    cvals = [crow.get(cname) for crow in rows]
+    if any(isinstance(cval, str) for cval in cvals):
+        return np.array(
+            ["" if cval is None else str(cval) for cval in cvals], dtype=object
+        )
+    return np.array([np.nan if cval is None else cval for cval in cvals], dtype=float)
+
+
+def write_catalog(filename, rows):
+    """
+    Write the catalog rows as one dataset per column
+
+    Parameters
+    ----------
+    filename : str
+        catalog file (hdf5)
+    rows : list of dict
+        catalog rows
+    """
+    colnames = list(info_names)
+    for crow in rows:
+        colnames += [cname for cname in crow.keys() if cname not in colnames]
+
+    tmpname = f"{filename}.tmp"
+    with h5py.File(tmpname, "w") as hfile:
+        hfile.attrs["colnames"] = colnames
+        for cname in colnames:
+            cvals = column_array(rows, cname)
+            if cvals.dtype == object:
+                hfile.create_dataset(cname, data=cvals, dtype=h5py.string_dtype())
+            else:
+                hfile.create_dataset(cname, data=cvals)
+    # replace in one step so readers never see a partial catalog
+    os.replace(tmpname, filename)
+
+
+def read_catalog(filename, columns=None):
+    """
+    Read the results catalog
+
+    Parameters
+    ----------
+    filename : str
+        catalog file (hdf5)
+    columns : list of str
+        columns to read, default is all
+
+    Returns
+    -------
+    cat : astropy Table
+        one row for each star and fit type
+    """
+    cat = Table()
+    with h5py.File(filename, "r") as hfile:
+        if columns is None:
+            columns = list(hfile.attrs["colnames"])
+        for cname in columns:
+            dset = hfile[cname]
+            if h5py.check_string_dtype(dset.dtype) is not None:
+                cat[cname] = dset.asstr()[()]
+            else:
+                cat[cname] = dset[()]
+    return cat
+
+
+def update_catalog(filename, extfiles, rebuild=False):
+    """
+    Add new or changed extinction files to the catalog
+
+    Only the extinction files that are new or whose modification time or size
+    has changed are read.  Stars whose extinction file is no longer present
+    are removed.
+
+    Parameters
+    ----------
+    filename : str
+        catalog file (hdf5)
+    extfiles : list of str
+        extinction files written by fit_model.py
+    rebuild : boolean
+        set to read all the extinction files
+
+    Returns
+    -------
+    nread, nkept, nremoved : int
+        number of extinction files read, kept from the catalog, and removed
+    """
+    current = {}
+    if os.path.isfile(filename) and not rebuild:
+        cat = read_catalog(filename)
+        for crow in cat:
+            crow = {
+                cname: crow[cname]
+                for cname in cat.colnames
+                if not (isinstance(crow[cname], float) and np.isnan(crow[cname]))
+                and crow[cname] != ""
+            }
+            current.setdefault(crow["file"], []).append(crow)
+
+    rows = []
+    nread = 0
+    nkept = 0
+    for cfile in sorted(extfiles):
+        fstat = os.stat(cfile)
+        crows = current.pop(cfile, None)
+        if (
+            crows is not None
+            and crows[0]["mtime"] == fstat.st_mtime
+            and crows[0]["size"] == fstat.st_size
+        ):
+            nkept += 1
+        else:
+            crows = read_extfile(cfile)
+            nread += 1
+        rows += crows
+
+    write_catalog(filename, rows)
+
+    return nread, nkept, len(current)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--extpath", help="path to the extinction files", default="./exts/"
+    )
+    parser.add_argument(
+        "--catalog",
+        help="results catalog file",
+        default="./exts/results_catalog.h5",
+    )
+    parser.add_argument(
+        "--rebuild", help="read all the extinction files", action="store_true"
+    )
+    args = parser.parse_args()
+
+    start_time = time.time()
+    extfiles = glob.glob(os.path.join(args.extpath, "*_mefit_ext.fits"))
+    nread, nkept, nremoved = update_catalog(args.catalog, extfiles, args.rebuild)
+    print(f"{nread} extinction files read, {nkept} unchanged, {nremoved} removed")
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
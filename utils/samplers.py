@@ -0,0 +1,287 @@
+import copy
+import os
+
+import numpy as np
+import emcee
+
+from measure_extinction.model import MEModel
+
+from fit_hessian import get_fit_names
+
+# move sets that can be selected, "gaussian" also needs a covariance
+move_types = ["stretch", "de", "desnooker", "gaussian"]
+
+
+def cpu_time():
+    """
+    CPU time used by this process and its finished children [s]
+    """
+    return sum(os.times()[:4])
+
+
+def make_moves(movetype, covar=None):
+    """
+    emcee moves for a move type
+
+    Parameters
+    ----------
+    movetype : str
+        one of move_types
+    covar : ndarray
+        covariance of the fit parameters, needed for gaussian moves
+
+    Returns
+    -------
+    moves : emcee move or list of (move, weight)
+    """
+    if movetype == "stretch":
+        return emcee.moves.StretchMove()
+    elif movetype == "de":
+        return [(emcee.moves.DEMove(), 0.8), (emcee.moves.DESnookerMove(), 0.2)]
+    elif movetype == "desnooker":
+        return [(emcee.moves.DESnookerMove(), 0.5), (emcee.moves.DEMove(), 0.5)]
+    elif movetype == "gaussian":
+        if covar is None:
+            raise ValueError("gaussian moves need a covariance")
+        # optimal scaling for a Gaussian random walk metropolis
+        ndim = covar.shape[0]
+        return emcee.moves.GaussianMove(covar * 2.38**2 / ndim)
+    raise ValueError(f"move type {movetype} not one of {move_types}")
+
+
+def tempered_lnprob(params, memod, obsdata, modinfo, beta):
+    """
+    Log(prior) + beta log(likelihood), the log(likelihood) is returned as a blob
+    """
+    memod.fit_to_parameters(params)
+    lnp = memod.lnprior()
+    if not np.isfinite(lnp):
+        return -np.inf, -np.inf
+    lnl = memod.lnlike(obsdata, modinfo)
+    return lnp + beta * lnl, lnl
+
+
+def initial_walkers(memod, nwalkers, scatter=1e-3, rng=None):
+    """
+    Walkers in a small ball around the current parameters, inside the bounds
+    """
+    rng = np.random.default_rng(rng)
+    names = get_fit_names(memod)
+    vals = np.array([getattr(memod, cname).value for cname in names])
+    p0 = vals + scatter * np.maximum(np.absolute(vals), 1e-2) * rng.standard_normal(
+        (nwalkers, len(vals))
+    )
+    for k, cname in enumerate(names):
+        bounds = getattr(memod, cname).bounds
+        if bounds is not None:
+            lo = bounds[0] if bounds[0] is not None else -np.inf
+            hi = bounds[1] if bounds[1] is not None else np.inf
+            p0[:, k] = np.clip(p0[:, k], lo, hi)
+    return p0
+
+
+def burnin_covariance(memod, obsdata, modinfo, p0, nsteps):
+    """
+    Covariance of the fit parameters from a short run with DE moves
+
+    Returns
+    -------
+    covar, state : ndarray, emcee.State
+        covariance from the second half of the run and the final walkers
+    """
+    nwalkers, ndim = p0.shape
+    sampler = emcee.EnsembleSampler(
+        nwalkers,
+        ndim,
+        MEModel.lnprob,
+        args=(memod, obsdata, modinfo),
+        moves=make_moves("de"),
+    )
+    state = sampler.run_mcmc(p0, nsteps, progress=True)
+    samples = sampler.get_chain(discard=nsteps // 2, flat=True)
+    return np.cov(samples, rowvar=False), state
+
+
+def run_tempered(
+    memod, obsdata, modinfo, p0, nsteps, moves, ntemps, tmax, nswap=10, backend=None
+):
+    """
+    Parallel tempering with one ensemble sampler for each temperature
+
+    The temperatures are geometrically spaced from 1 to tmax.  Every nswap
+    steps, walkers of adjacent temperatures are proposed to be swapped.
+    Only the samples of the temperature 1 ensemble are kept.
+
+    Returns
+    -------
+    sampler : emcee.EnsembleSampler
+        sampler for temperature 1
+    """
+    nwalkers, ndim = p0.shape
+    rng = np.random.default_rng()
+    betas = np.geomspace(1.0, 1.0 / tmax, ntemps)
+    samplers = [
+        emcee.EnsembleSampler(
+            nwalkers,
+            ndim,
+            tempered_lnprob,
+            args=(memod, obsdata, modinfo, cbeta),
+            moves=moves,
+            backend=backend if k == 0 else None,
+        )
+        for k, cbeta in enumerate(betas)
+    ]
+    states = [p0] * ntemps
+    naccept = np.zeros(ntemps - 1)
+    nswaps = 0
+    for i0 in range(0, nsteps, nswap):
+        cnsteps = min(nswap, nsteps - i0)
+        states = [
+            csampler.run_mcmc(cstate, cnsteps, progress=False)
+            for csampler, cstate in zip(samplers, states)
+        ]
+        nswaps += 1
+
+        # swaps between adjacent temperatures, from the hottest down
+        for k in range(ntemps - 2, -1, -1):
+            lnl = [states[k].blobs, states[k + 1].blobs]
+            lnp = [
+                states[k].log_prob - betas[k] * lnl[0],
+                states[k + 1].log_prob - betas[k + 1] * lnl[1],
+            ]
+            coords = [states[k].coords, states[k + 1].coords]
+            lnacc = (betas[k] - betas[k + 1]) * (lnl[1] - lnl[0])
+            swap = np.log(rng.random(nwalkers)) < lnacc
+            naccept[k] += np.mean(swap)
+            for m, n in [(k, 0), (k + 1, 1)]:
+                ncoords = np.where(swap[:, None], coords[1 - n], coords[n])
+                nlnl = np.where(swap, lnl[1 - n], lnl[n])
+                nlnp = np.where(swap, lnp[1 - n], lnp[n])
+                states[m] = emcee.State(
+                    ncoords,
+                    log_prob=nlnp + betas[m] * nlnl,
+                    blobs=nlnl,
+                    random_state=states[m].random_state,
+                )
+        if (i0 + cnsteps) % max(nsteps // 10, 1) < cnsteps:
+            print(f"step {i0 + cnsteps} of {nsteps}")
+    print(
+        "temperature swap acceptance: "
+        + " ".join(f"{cacc:.2f}" for cacc in naccept / max(nswaps, 1))
+    )
+    return samplers[0]
+
+
+def fit_sampler_moves(
+    memod,
+    obsdata,
+    modinfo,
+    nsteps=1000,
+    movetype="stretch",
+    covar=None,
+    nburnin=1000,
+    ntemps=1,
+    tmax=10.0,
+    nswap=10,
+    burnfrac=0.5,
+    save_samples=None,
+):
+    """
+    MCMC sampling with a selectable move set and optional parallel tempering
+
+    Parameters
+    ----------
+    memod : MEModel
+        model with the starting parameters (e.g., the minimizer result)
+    obsdata : StarData
+        observed data
+    modinfo : ModelData
+        model grid
+    nsteps : int
+        number of steps
+    movetype : str
+        one of move_types
+    covar : ndarray
+        covariance for gaussian moves (e.g., from the Hessian), default is to
+        estimate it from a run of nburnin steps with DE moves
+    nburnin : int
+        number of steps to estimate the covariance for gaussian moves
+    ntemps : int
+        number of temperatures, 1 for no tempering
+    tmax : float
+        highest temperature
+    nswap : int
+        number of steps between temperature swaps
+    burnfrac : float
+        fraction of the steps discarded as burn-in for the results
+    save_samples : str
+        file for the samples (emcee HDFBackend)
+
+    Returns
+    -------
+    outmod, flat_samples, sampler : MEModel, ndarray, emcee.EnsembleSampler
+        model with the p50 parameters and uncertainties, samples after the
+        burn-in, and sampler (temperature 1)
+    """
+    ndim = len(get_fit_names(memod))
+    nwalkers = 2 * ndim
+    p0 = initial_walkers(memod, nwalkers)
+
+    if movetype == "gaussian" and covar is None:
+        print(f"estimating the covariance from {nburnin} steps with DE moves")
+        covar, state = burnin_covariance(memod, obsdata, modinfo, p0, nburnin)
+        p0 = state.coords
+    moves = make_moves(movetype, covar=covar)
+
+    backend = None
+    if save_samples is not None:
+        backend = emcee.backends.HDFBackend(save_samples)
+        backend.reset(nwalkers, ndim)
+
+    if ntemps > 1:
+        sampler = run_tempered(
+            memod,
+            obsdata,
+            modinfo,
+            p0,
+            nsteps,
+            moves,
+            ntemps,
+            tmax,
+            nswap=nswap,
+            backend=backend,
+        )
+    else:
+        sampler = emcee.EnsembleSampler(
+            nwalkers,
+            ndim,
+            MEModel.lnprob,
+            args=(memod, obsdata, modinfo),
+            moves=moves,
+            backend=backend,
+        )
+        sampler.run_mcmc(p0, nsteps, progress=True)
+
+    flat_samples = sampler.get_chain(discard=int(burnfrac * nsteps), flat=True)
+    per = np.percentile(flat_samples, [16, 50, 84], axis=0)
+    outmod = copy.deepcopy(memod)
+    outmod.fit_to_parameters(per[1], uncs=0.5 * (per[2] - per[0]))
+    return outmod, flat_samples, sampler
+
+
+def sampling_efficiency(sampler, cpu_hours, burnfrac=0.5):
+    """
+    Effective number of samples and effective samples per CPU-hour
+
+    The effective number of samples is for the parameter with the longest
+    autocorrelation time after discarding the burn-in.
+
+    Returns
+    -------
+    ess, ess_per_hour : float
+    """
+    nsteps = sampler.iteration
+    nburn = int(burnfrac * nsteps)
+    tau = np.max(sampler.get_autocorr_time(discard=nburn, quiet=True))
+    ess = (nsteps - nburn) * sampler.nwalkers / tau
+    return ess, ess / max(cpu_hours, 1e-10)
@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# job states, each one is a subdirectory of the queue directory
+states = ["pending", "running", "done", "failed"]
+
+
+def _write_job(queuedir, state, jobname, job):
+    """
+    Write a job file, it appears in the state directory in one step
+    """
+    tmpname = os.path.join(queuedir, f".{jobname}.{os.getpid()}.tmp")
+    with open(tmpname, "w") as jfile:
+        json.dump(job, jfile)
+    os.rename(tmpname, os.path.join(queuedir, state, jobname))
+
+
+def setup_queue(queuedir):
+    """
+    Create the queue directories
+    """
+    for cstate in states:
+        os.makedirs(os.path.join(queuedir, cstate), exist_ok=True)
+
+
+def submit(queuedir, starnames, options=""):
+    """
+    Add fit_model.py jobs to the queue
+
+    Parameters
+    ----------
+    queuedir : str
+        queue directory on the shared filesystem
+    starnames : list of str
+        stars to fit, one job per star
+    options : str
+        fit_model.py options (e.g., "--picmodel --Av_init=0.1 --mcmc")
+    """
+    setup_queue(queuedir)
+    for starname in starnames:
+        job = {
+            "star": starname,
+            "options": options,
+            "submitted": time.time(),
+            "attempts": 0,
+        }
+        jobname = f"{time.time():.6f}_{starname}.json"
+        _write_job(queuedir, "pending", jobname, job)
+        print(f"submitted {jobname}")
+
+
+def claim(queuedir, workerid):
+    """
+    Claim the oldest pending job
+
+    os.rename is atomic, so only one worker can move a job from pending to
+    running, the others get an error and try the next job.  The job file
+    modification time is updated before and after the rename, so a job that
+    waited in pending for longer than the timeout is not seen as dead.
+
+    Returns
+    -------
+    runname, job : str, dict
+        name of the job file in running and the job, None if no pending jobs
+    """
+    for jobname in sorted(os.listdir(os.path.join(queuedir, "pending"))):
+        runname = f"{workerid}__{jobname}"
+        runfile = os.path.join(queuedir, "running", runname)
+        try:
+            os.utime(os.path.join(queuedir, "pending", jobname))
+            os.rename(os.path.join(queuedir, "pending", jobname), runfile)
+            os.utime(runfile)
+        except FileNotFoundError:
+            continue
+        job = json.load(open(runfile))
+        return runname, job
+    return None, None
+
+
+def finish(queuedir, runname, job, returncode):
+    """
+    Move a job from running to done or failed
+
+    Returns
+    -------
+    finished : boolean
+        False if the job is no longer ours (it was requeued)
+    """
+    job["returncode"] = returncode
+    job["finished"] = time.time()
+    state = "done" if returncode == 0 else "failed"
+    try:
+        os.unlink(os.path.join(queuedir, "running", runname))
+    except FileNotFoundError:
+        return False
+    _write_job(queuedir, state, runname.split("__", 1)[1], job)
+    return True
+
+
+def requeue_dead(queuedir, timeout, max_attempts=3):
+    """
+    Requeue running jobs without a heartbeat for more than timeout
+
+    Parameters
+    ----------
+    queuedir : str
+        queue directory
+    timeout : float
+        time since the last heartbeat for a worker to be dead [s]
+    max_attempts : int
+        jobs that have been requeued this many times are failed instead
+
+    Returns
+    -------
+    nrequeued : int
+        number of jobs requeued or failed
+    """
+    nrequeued = 0
+    rundir = os.path.join(queuedir, "running")
+    for runname in os.listdir(rundir):
+        runfile = os.path.join(rundir, runname)
+        try:
+            if time.time() - os.path.getmtime(runfile) < timeout:
+                continue
+            # claim the dead job so only one worker requeues it
+            deadfile = os.path.join(queuedir, f".{runname}.{os.getpid()}.dead")
+            os.rename(runfile, deadfile)
+        except FileNotFoundError:
+            continue
+        job = json.load(open(deadfile))
+        job["attempts"] += 1
+        job.setdefault("dead_workers", []).append(runname.split("__", 1)[0])
+        jobname = runname.split("__", 1)[1]
+        if job["attempts"] >= max_attempts:
+            _write_job(queuedir, "failed", jobname, job)
+        else:
+            _write_job(queuedir, "pending", jobname, job)
+        os.unlink(deadfile)
+        print(f"requeued {jobname} from dead worker {runname.split('__', 1)[0]}")
+        nrequeued += 1
+    return nrequeued
+
+
+def _heartbeat(runfile, interval, stop, proc=None):
+    """
+    Update the modification time of the running job file until stopped,
+    starting immediately
+
+    If the file is gone (the job was requeued by another worker), the job
+    process and its process group are terminated so the star is not fit
+    twice into the same files.
+    """
+    while True:
+        try:
+            os.utime(runfile)
+        except FileNotFoundError:
+            if proc is not None and proc.poll() is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            return
+        if stop.wait(interval):
+            return
+
+
+def run_job(queuedir, runname, job, interval, command, nice):
+    """
+    Run one fit_model.py job with heartbeats, the log is logs/{star}.log
+
+    The job is stopped if it is requeued by another worker.
+
+    Returns
+    -------
+    returncode : int
+        exit status of fit_model.py (negative if stopped)
+    """
+    runfile = os.path.join(queuedir, "running", runname)
+    stop = threading.Event()
+
+    os.makedirs("logs", exist_ok=True)
+    cmd = [sys.executable, command, job["star"]] + shlex.split(job["options"])
+    with open(f"logs/{job['star']}.log", "w") as lfile:
+        # in its own process group so its worker processes are also stopped
+        proc = subprocess.Popen(
+            cmd,
+            stdout=lfile,
+            stderr=subprocess.STDOUT,
+            preexec_fn=lambda: os.nice(nice),
+            start_new_session=True,
+        )
+        beat = threading.Thread(target=_heartbeat, args=(runfile, interval, stop, proc))
+        beat.daemon = True
+        beat.start()
+        proc.wait()
+    stop.set()
+    beat.join()
+    return proc.returncode
+
+
+def worker(queuedir, interval=30.0, timeout=300.0, exit_when_empty=False, **kwargs):
+    """
+    Run jobs from the queue until stopped
+
+    Parameters
+    ----------
+    queuedir : str
+        queue directory
+    interval : float
+        time between heartbeats and between checks for new jobs [s]
+    timeout : float
+        time without a heartbeat after which a job is requeued [s]
+    exit_when_empty : boolean
+        set to stop when there are no pending or running jobs
+    kwargs : dict
+        passed to run_job (command, nice)
+    """
+    setup_queue(queuedir)
+    workerid = f"{socket.gethostname()}.{os.getpid()}"
+    print(f"worker {workerid} started")
+    while True:
+        requeue_dead(queuedir, timeout)
+        runname, job = claim(queuedir, workerid)
+        if job is None:
+            if exit_when_empty and not os.listdir(os.path.join(queuedir, "running")):
+                break
+            time.sleep(interval)
+            continue
+
+        print(f"{workerid}: starting {job['star']} {job['options']}")
+        start_time = time.time()
+        returncode = run_job(queuedir, runname, job, interval, **kwargs)
+        if finish(queuedir, runname, job, returncode):
+            print(
+                f"{workerid}: finished {job['star']}, status {returncode}, "
+                f"{time.time() - start_time:.1f} seconds"
+            )
+        else:
+            print(f"{workerid}: {job['star']} was requeued by another worker")
+    print(f"worker {workerid} finished, no more jobs")
+
+
+def status(queuedir):
+    """
+    Print the number of jobs in each state and the running jobs
+    """
+    for cstate in states:
+        print(f"{cstate}: {len(os.listdir(os.path.join(queuedir, cstate)))}")
+    for runname in sorted(os.listdir(os.path.join(queuedir, "running"))):
+        cage = time.time() - os.path.getmtime(
+            os.path.join(queuedir, "running", runname)
+        )
+        workerid, jobname = runname.split("__", 1)
+        print(f"  {jobname} on {workerid}, last heartbeat {cage:.0f} s ago")
+    for jobname in sorted(os.listdir(os.path.join(queuedir, "failed"))):
+        job = json.load(open(os.path.join(queuedir, "failed", jobname)))
+        print(f"  failed: {jobname} (status {job.get('returncode')})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--queuedir",
+        help="queue directory, needs to be on a filesystem shared by the workers",
+        default="./queue/",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    psubmit = subparsers.add_parser("submit", help="add fits to the queue")
+    psubmit.add_argument("starnames", nargs="+", help="names of stars")
+    psubmit.add_argument(
+        "--options",
+        help='fit_model.py options, e.g., --options="--picmodel --mcmc"',
+        default="",
+    )
+
+    pworker = subparsers.add_parser("worker", help="run fits from the queue")
+    pworker.add_argument(
+        "--interval", help="heartbeat interval [s]", default=30.0, type=float
+    )
+    pworker.add_argument(
+        "--timeout",
+        help="requeue jobs without a heartbeat for this long [s]",
+        default=300.0,
+        type=float,
+    )
+    pworker.add_argument(
+        "--exit_when_empty", help="stop when the queue is empty", action="store_true"
+    )
+    pworker.add_argument(
+        "--fitcommand",
+        help="fitting script",
+        default=os.path.join(os.path.dirname(__file__), "fit_model.py"),
+    )
+    pworker.add_argument("--nice", help="nice increment for fits", default=19, type=int)
+
+    subparsers.add_parser("status", help="print the state of the queue")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        submit(args.queuedir, args.starnames, args.options)
+    elif args.command == "worker":
+        worker(
+            args.queuedir,
+            interval=args.interval,
+            timeout=args.timeout,
+            exit_when_empty=args.exit_when_empty,
+            command=args.fitcommand,
+            nice=args.nice,
+        )
+    else:
+        status(args.queuedir)
+
+
+if __name__ == "__main__":
+    main()